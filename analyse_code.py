@@ -1,36 +1,184 @@
 #!/usr/bin/env python3
 
-import requests
+import argparse
+import asyncio
+import json
+import os
 import sys
-import wget
-from urllib.request import urlopen
+import tarfile
+import tempfile
+from collections import defaultdict
 
-file_name = sys.argv[1]
+from cache import BlobCache
+from fetch import RAW_BASE, FetchError, Fetcher, add_arguments as add_fetch_arguments, raw_url_candidates
+from ingest import SOURCE_SUFFIXES
 
-file = open(f'output/{file_name}', 'r')
+API_BASE = 'https://api.github.com'
+MAX_FILE_BYTES = 1024 * 1024
 
-file_contents = {}
-repos = []
-for line in file.readlines():
-    try:
-        repo_name, repo_path = line.strip().split(' ', 1)
-        repo_path = repo_path.replace(' ', '%20')
-    except:
-        print(f'unable to split line: {line}')
-        continue
+def read_search_output(path):
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                repo_name, repo_path = line.strip().split(' ', 1)
+                repo_path = repo_path.replace(' ', '%20')
+            except:
+                print(f'unable to split line: {line}')
+                continue
+            yield repo_name, repo_path
 
-    try:
-        link = f'https://raw.githubusercontent.com/{repo_name}/main/{repo_path}'
-        if requests.get(link).status_code > 400:
-            link = f'https://raw.githubusercontent.com/{repo_name}/master/{repo_path}'
-            if requests.get(link).status_code > 400:
+async def download_files(entries, raw_base=RAW_BASE, concurrency=32, per_host_rate=None, cache=None):
+    repos = []
+    jobs = {}
+    for repo_name, repo_path in entries:
+        candidates = tuple(raw_url_candidates(repo_name, repo_path, raw_base))
+        jobs[candidates] = (repo_name, repo_path)
+
+    async with Fetcher(concurrency=concurrency, per_host_rate=per_host_rate, cache=cache) as fetcher:
+        async for candidates, res in fetcher.fetch_many(jobs):
+            if res is None:
+                continue
+            repo_name, repo_path = jobs[candidates]
+            repos.append((save_download(repo_name, repo_path, res), repo_name, repo_path))
+    return repos
+
+def local_name(repo_name, repo_path):
+    return f'{repo_name}/{repo_path}'.replace('/','_')
+
+def save_download(repo_name, repo_path, res):
+    repo_fn = local_name(repo_name, repo_path)
+    if not (res.cached and os.path.exists('repos/'+repo_fn)):
+        with open('repos/'+repo_fn, 'wb') as f:
+            f.write(res.body)
+    return repo_fn
+
+def github_headers(token_path='github_token'):
+    headers = {'Accept': 'application/vnd.github+json', 'X-GitHub-Api-Version': '2022-11-28'}
+    if os.path.exists(token_path):
+        with open(token_path, 'r') as f:
+            headers['Authorization'] = f'Bearer {f.readline().strip()}'
+    return headers
+
+def extract_sources(archive, repo_name, max_file_bytes=MAX_FILE_BYTES):
+    '''
+    Reads a repository tarball front to back and writes its .py and .ipynb
+    members to repos/, named the way save_download names single files. Returns
+    their repos.txt entries and the paths of the sources left out for being
+    over max_file_bytes. Member paths never reach the filesystem as paths, so
+    an archive cannot write outside repos/.
+    '''
+    repos = []
+    too_large = set()
+    with tarfile.open(archive, 'r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(SOURCE_SUFFIXES):
+                continue
+            # members sit under an <owner>-<repo>-<sha>/ directory
+            repo_path = member.name.split('/', 1)[-1].replace(' ', '%20')
+            if member.size > max_file_bytes:
+                too_large.add(repo_path)
                 continue
-        repo_fn = f'{repo_name}/{repo_path}'.replace('/','_')
-        wget.download(link, 'repos/'+repo_fn)
-        repos.append((repo_fn, repo_name, repo_path))
-    except:
-        continue
-
-with open('repos/repos.txt', 'a') as f:
-    for repo in repos:
-        f.write(str(repo) + '\n')
\ No newline at end of file
+            repo_fn = local_name(repo_name, repo_path)
+            with tar.extractfile(member) as source, open('repos/' + repo_fn, 'wb') as f:
+                while chunk := source.read(1 << 16):
+                    f.write(chunk)
+            repos.append((repo_fn, repo_name, repo_path))
+    return repos, too_large
+
+async def download_archive(fetcher, repo_name, api_base=API_BASE, headers=None, max_file_bytes=MAX_FILE_BYTES):
+    # the default branch comes from the api, whose answer the blob cache revalidates for free
+    res = await fetcher.fetch(f'{api_base}/repos/{repo_name}', headers)
+    if res.status != 200:
+        raise FetchError(f'{repo_name}: status {res.status}')
+    branch = json.loads(res.body)['default_branch']
+    with tempfile.TemporaryDirectory() as directory:
+        archive = os.path.join(directory, 'archive.tar.gz')
+        res = await fetcher.download(f'{api_base}/repos/{repo_name}/tarball/{branch}', archive, headers)
+        if res.status != 200:
+            raise FetchError(f'{repo_name}: tarball status {res.status}')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, extract_sources, archive, repo_name, max_file_bytes)
+
+async def download_archives(entries, api_base=API_BASE, raw_base=RAW_BASE, concurrency=8, cache=None,
+                            max_file_bytes=MAX_FILE_BYTES, per_host_rate=None):
+    '''
+    Downloads each repository with search hits once, as a tarball of its default
+    branch, and keeps every .py and .ipynb file in it, so that the modules next
+    to a hit are there for cross-file tracing. Hits of repositories whose
+    archive cannot be had, and hits too large to keep from the archive, are
+    downloaded one by one as before.
+    '''
+    hits = defaultdict(list)
+    for repo_name, repo_path in entries:
+        hits[repo_name].append(repo_path)
+    headers = github_headers()
+    repos = []
+    fallback = []
+    async with Fetcher(concurrency=concurrency, per_host_rate=per_host_rate, cache=cache) as fetcher:
+        tasks = {repo_name: asyncio.ensure_future(download_archive(fetcher, repo_name, api_base, headers, max_file_bytes))
+                 for repo_name in hits}
+        for repo_name, task in tasks.items():
+            try:
+                extracted, too_large = await task
+            except (FetchError, tarfile.TarError, KeyError, ValueError) as e:
+                print(f'unable to download the archive of {repo_name}: {e}')
+                fallback += [(repo_name, repo_path) for repo_path in hits[repo_name]]
+                continue
+            found = {repo_path for _, _, repo_path in extracted}
+            large = [repo_path for repo_path in hits[repo_name] if repo_path in too_large]
+            missing = [repo_path for repo_path in hits[repo_name] if repo_path not in found and repo_path not in too_large]
+            if large:
+                print(f'{repo_name}: {len(large)} hits over --max-file-bytes in the archive, downloading them on their own')
+                fallback += [(repo_name, repo_path) for repo_path in large]
+            if missing:
+                print(f'{repo_name}: {len(missing)} hits not in the archive of the default branch')
+            repos += extracted
+    if fallback:
+        repos += await download_files(fallback, raw_base, concurrency, per_host_rate, cache)
+    return repos
+
+def known_repos(path='repos/repos.txt'):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return {line.strip() for line in f}
+
+def append_repos(repos, path='repos/repos.txt'):
+    # one write for the whole batch, skipping files the list already has
+    known = known_repos(path)
+    lines = list(dict.fromkeys(str(repo) for repo in repos if str(repo) not in known))
+    with open(path, 'a') as f:
+        f.writelines(line + '\n' for line in lines)
+    return len(lines)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Download the files found by repo_search.py into repos/.')
+    parser.add_argument('file_name', help='search results under output/')
+    parser.add_argument('--archives', action='store_true',
+                        help='download each repository once as a tarball of its default branch instead of every hit '
+                             'separately, keeping all its .py and .ipynb files')
+    parser.add_argument('--api-base', default=API_BASE, help='github api, or a local archive server')
+    parser.add_argument('--raw-base', default=RAW_BASE)
+    parser.add_argument('--concurrency', type=int, help='parallel downloads (default 32 files or 8 archives)')
+    parser.add_argument('--max-file-bytes', type=int, default=MAX_FILE_BYTES, help='larger archive members are skipped')
+    add_fetch_arguments(parser)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    entries = read_search_output(f'output/{args.file_name}')
+    os.makedirs('repos', exist_ok=True)
+    cache = BlobCache()
+    try:
+        if args.archives:
+            repos = asyncio.run(download_archives(entries, args.api_base, args.raw_base, args.concurrency or 8, cache,
+                                                  args.max_file_bytes, args.per_host_rate))
+        else:
+            repos = asyncio.run(download_files(entries, args.raw_base, args.concurrency or 32, args.per_host_rate, cache))
+    finally:
+        cache.close()
+
+    print(f'{append_repos(repos)} files added to repos/repos.txt')
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,61 @@
+import argparse
 import os
 import json
 import pprint
 import re
+import sys
+from bisect import bisect_left
 
-def filter_repos():
-    with open('parse.json') as f:
-        parse_results = json.load(f)
+import numpy as np
+import pandas as pd
 
-    final = {}
-    for result in parse_results:
-        if result['create_calls'] == []:
-            continue
+from dedup import LSHIndex
+from jsonl import read_jsonl
+from store import ResultStore, repo_of
 
-        if all("originates as a parameter in function" in call for call in result['create_calls']):
-            continue
-        
-        final[result['url']] = result['create_calls']
-    return final
+def load_parse_results(path):
+    # parse.jsonl from `parse.py --jsonl` is read one record at a time; its error and
+    # skipped records carry no create_calls
+    if path.endswith('.jsonl'):
+        return read_jsonl(path)
+    with open(path) as f:
+        return json.load(f)
 
-def find_length(input_string):
-    return len(re.findall(r'\w+', input_string))
+def is_relevant(result):
+    if 'create_calls' not in result or result['create_calls'] == []:
+        return False
 
-def find_fstring_indices(input_string):
-    matches = []
-    for fstr in re.finditer(r'\{[^{}]*\}|%s', input_string):
-        word_index = len(re.findall(r'\w+', input_string[:fstr.start()])) # supports .format method
-        matches.append(word_index + 1)
-    return matches
+    if all("originates as a parameter in function" in call for call in result['create_calls']):
+        return False
+    return True
 
-def main():
-    repos = filter_repos()
+def filter_repos(path='parse.json'):
+    for result in load_parse_results(path):
+        if is_relevant(result):
+            yield result['url'], result['create_calls']
+
+WORD = re.compile(r'\w+')
+PLACEHOLDER = re.compile(r'\{[^{}]*\}|%s') # supports .format method
+CONTENT = re.compile(r'"content"\s*:\s*"([^"]*)"|\'content\'\s*:\s*\'([^\']*)\'')
 
+def word_starts(input_string):
+    return [word.start() for word in WORD.finditer(input_string)]
+
+def find_length(input_string):
+    return len(word_starts(input_string))
+
+def find_fstring_indices(input_string, starts=None):
+    # a placeholder never starts inside a word, so the words before it are exactly
+    # those starting before it: one bisect into the word offsets instead of a rescan
+    if starts is None:
+        starts = word_starts(input_string)
+    return [bisect_left(starts, fstr.start()) + 1 for fstr in PLACEHOLDER.finditer(input_string)]
+
+def collect_prompts(repos):
+    # prompt -> repos using it; a dict keyed by repo is an ordered set, so
+    # membership is O(1) and repos keep their first-seen order
     result = {}
-    for repo, parse in repos.items():
+    for repo, parse in repos:
         for line in parse:
             if 'originates' in line:
                 pass
@@ -44,35 +67,109 @@ def main():
                 if prompt_value.startswith('['):
                     continue # not relevant prompts
 
-                words = re.findall(r'\S+', prompt_value) # get rid of whitespaces
-                prompt_value = ' '.join(words)
+                prompt_value = ' '.join(prompt_value.split()) # get rid of whitespaces
 
                 if '\"content\"' in prompt_value or '\'content\'' in prompt_value:
-                    for content in re.finditer(r'"content"\s*:\s*"([^"]*)"|\'content\'\s*:\s*\'([^\']*)\'', prompt_value):
+                    for content in CONTENT.finditer(prompt_value):
                         matched = content.group(1) or content.group(2)
-                        if matched not in result:
-                            result[matched] = []
-                        if repo not in result[matched]:
-                            result[matched].append(repo)
+                        result.setdefault(matched, {})[repo] = None
                 else:
-                    if prompt_value not in result:
-                        result[prompt_value] = []
-                    if repo not in result[prompt_value]:
-                        result[prompt_value].append(repo)
+                    result.setdefault(prompt_value, {})[repo] = None
+    return result
+
+def prompt_statistics(prompts):
+    '''
+    Per-prompt statistics as columns over the whole corpus. Each insertion's
+    position is (index - 1) / length: 0 before the first word, 1 after the last.
+    '''
+    n = len(prompts)
+    lengths = np.zeros(n, dtype=np.int64)
+    counts = np.zeros(n, dtype=np.int64)
+    flat = []
+    for i, prompt in enumerate(prompts):
+        starts = word_starts(prompt)
+        indices = find_fstring_indices(prompt, starts)
+        lengths[i] = len(starts)
+        counts[i] = len(indices)
+        flat.extend(indices)
+
+    indices = np.array(flat, dtype=np.int64)
+    owners = np.repeat(np.arange(n), counts)
+    positions = (indices - 1) / np.maximum(lengths, 1)[owners]
+    offsets = np.cumsum(counts) - counts
+    dynamic = counts > 0
+
+    stats = pd.DataFrame({'prompt': prompts, 'length': lengths, 'insertions': counts})
+    stats['insertion_ratio'] = counts / np.maximum(lengths, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['mean_position'] = np.bincount(owners, weights=positions, minlength=n) / counts
+    stats['first_position'] = np.nan
+    stats['last_position'] = np.nan
+    stats.loc[dynamic, 'first_position'] = positions[offsets[dynamic]]
+    stats.loc[dynamic, 'last_position'] = positions[offsets[dynamic] + counts[dynamic] - 1]
+    placement = np.select([stats['mean_position'] < 1 / 3, stats['mean_position'] > 2 / 3], ['beginning', 'end'], 'middle')
+    stats['placement'] = pd.Series(np.where(dynamic, placement, None), dtype=object)  # object keeps None as None
+    return stats, np.split(indices, np.cumsum(counts)[:-1]), np.split(positions, np.cumsum(counts)[:-1])
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?', default='parse.json', help='parse.py output, .json or .jsonl')
+    parser.add_argument('--dedup', type=float, metavar='THRESHOLD',
+                        help='label each prompt with the longest prompt it is a near-duplicate of (e.g. 0.8)')
+    parser.add_argument('--parquet', metavar='DIR', help='also write one row per (prompt, file) as parquet under DIR')
+    parser.add_argument('--run', help='parquet partition to write to, defaults to the start time')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    repos = filter_repos(args.path)
+    result = collect_prompts(repos)
+
     # want statistics: position/length, prompt length, number of insertions, position of insertions (exact position and percentage position), percentage of insertions within a prompt, the more flexible the insertions are the better, closer to the beginning
-    
-    final_result = {}
-    for prompt in result.keys():
-        final_result[prompt] = {
-            'repos': result[prompt], 
-            'length': find_length(prompt),
-            'indices': find_fstring_indices(prompt)
-        }
+    prompts = sorted(result, key=len, reverse=True)
+    stats, indices, positions = prompt_statistics(prompts)
+    clusters = {}
+    if args.dedup:
+        # prompts are short, so shingles of 3 tokens rather than 5
+        index = LSHIndex(args.dedup, shingle=3)
+        clusters = {prompt: index.add(prompt, prompt) for prompt in prompts}
+        print(f'{len(prompts)} prompts in {index.clusters()} near-duplicate clusters')
 
-    sorted_result = {k: v for k, v in sorted(final_result.items(), key=lambda item: len(item[0]), reverse=True)}
+    sorted_result = {}
+    for row, prompt_indices, prompt_positions in zip(stats.itertuples(index=False), indices, positions):
+        sorted_result[row.prompt] = {
+            'repos': list(result[row.prompt]),
+            'length': int(row.length),
+            'indices': prompt_indices.tolist(),
+            'positions': prompt_positions.round(4).tolist(),
+            'insertion_ratio': round(float(row.insertion_ratio), 4),
+            'placement': row.placement
+        }
+        if clusters:
+            sorted_result[row.prompt]['cluster'] = clusters[row.prompt]
 
     with open('analysis.json', 'w') as file:
         json.dump(sorted_result, file, indent=4)
 
+    if args.parquet:
+        with ResultStore(args.parquet, args.run) as store:
+            for row, prompt_indices, prompt_positions in zip(stats.itertuples(index=False), indices, positions):
+                for url in result[row.prompt]:
+                    store.write('prompts', {
+                        'prompt': row.prompt, 'url': url, 'repo': repo_of(url),
+                        'length': row.length, 'insertions': row.insertions,
+                        'indices': prompt_indices, 'positions': prompt_positions,
+                        'insertion_ratio': row.insertion_ratio,
+                        'mean_position': row.mean_position if row.insertions else None,
+                        'placement': row.placement, 'cluster': clusters.get(row.prompt),
+                    })
+        print(f'parquet results written to {args.parquet} as run {store.run}')
+
+    dynamic = stats[stats['insertions'] > 0]
+    print(f'{len(stats)} prompts, {len(dynamic)} with insertions')
+    if len(dynamic):
+        print(dynamic['placement'].value_counts().to_string())
+        print(dynamic[['length', 'insertions', 'insertion_ratio', 'mean_position']].describe().to_string())
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
-from bs4 import BeautifulSoup
-from pathlib import Path
-from datetime import datetime
-import openai
-import pandas as pd
+import argparse
+import asyncio
+import json
+import sys
+from collections import Counter
 import re
 
-def create_prompt(code):
-    prompt = r'''
+from classifier import Classifier, ResponseCache
+from dedup import LSHIndex
+from metrics import add_arguments as add_metrics_arguments, start as start_metrics
+from parse import read_repos_file
+from slicer import read_code, slice_source
+from static_classifier import QUESTIONS, agreement, classify_code
+from store import ResultStore
+
+INSTRUCTIONS = r'''
     Please answer the following questions regarding the code. Please indicate the question each portions of the response is answering. Please do not use any additional sentences providing explanation other that what is asked by the question. Each question should be answerable in less than 20 words. Do not answer in complete sentences. Do not repeat the question back to me. There is an example below for what a response should look like. 
     1) Yes or No: Does the ChatCompletions API call use both a system and user for the conversation? 
     2) Is the user message static or dynamic? A static message refers to a constant string, while a dynamic message uses user input and variables to create the string. Dynamic inputs are variables taken from the command line that are inserted into the message string, typically by using format strings or concatenation. Function parameters are not dynamic tokens.
@@ -210,78 +217,304 @@ def create_prompt(code):
     4) N/A.
     5) N/A.
     '''
-    return f'The following is a piece of code: {code}\n' + prompt
-
-def transform_answers(answers):
-    res = (0, 0, [], 0, 0, 0)
-    try: 
-        q1, q2, q3, q4, q5 = answers
-    except:
-        raise Exception(f'unable to transform answers: {answers}')
-    
-    if q1 == 'Yes.':
-        res[0] = 1
-    elif q1 == 'No.':
-        pass
-    else:
-        raise Exception(f'invalid answers to question 1: {q1}')
-    
-    q2_split = q2.split(' ')
-    if q2_split[0] == 'Dynamic.':
-        res[1] = 1
-    elif q2_split[0] == 'Static.':
-        pass
-    else:
-        raise Exception(f'invalid answers to question 2: {q2}')
-    for word in q2_split:
-        if '`' in word:
-            res[2].append(word)
-
-    if q3 == 'Not English.':
-        res[3] = -1
-    else:
-        res[3] = int(q3[:-1])
-
-    if q4 == 'Beginning.':
-        res[4] = 0
-    elif q4 == 'Middle.':
-        res[4] = 1
-    elif q4 == 'End.':
-        res[4] = 2
-    else:
-        raise Exception(f'invalid answers to question 4: {q4}')
-    
-    steps_pattern = r'(\d+)\s+steps'
-    steps_match = re.search(steps_pattern, q5)
-    res[5] = int(steps_match.group(1))
-    
-    return res
-
-with open('openai_token', 'r') as f:
-    OPENAI_KEY = f.readline().strip()
-openai.api_key = OPENAI_KEY
 
-with open('repos/repos.txt', 'r') as f:
-    lines = f.readlines()
+def create_prompt(code):
+    return f'The following is a piece of code: {code}\n' + INSTRUCTIONS
+
+ANSWER = re.compile(r'^[ \t]*([1-5])\)[ \t]*(.*?)\s*$', re.M)
+
+def split_answers(text):
+    # the five numbered answers of a response, '' for any that is missing
+    answers = {int(number): answer for number, answer in ANSWER.findall(text)}
+    return [answers.get(number, '') for number in range(1, 6)]
+
+NOT_APPLICABLE = re.compile(r'\W*(n/?a\b|not applicable)', re.I)
+NOT_ENGLISH = re.compile(r'not\s+english', re.I)
+YES_NO = re.compile(r'\W*(yes|no)\b', re.I)
+KIND = re.compile(r'\b(static|dynamic)\b', re.I)
+VARIABLE = re.compile(r'`([^`]+)`')
+PLACEMENTS = {'beginning': 0, 'start': 0, 'middle': 1, 'end': 2}
+PLACEMENT = re.compile(r'\b(' + '|'.join(PLACEMENTS) + r')\b', re.I)
+NUMBER_WORDS = {'zero': 0, 'none': 0, 'no': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6,
+                'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10}
+NUMBER = re.compile(r'\b(\d+|' + '|'.join(NUMBER_WORDS) + r')\b', re.I)
+
+def read_yes_no(answer):
+    match = YES_NO.match(answer)
+    if not match:
+        raise ValueError(answer)
+    return int(match.group(1).lower() == 'yes')
+
+def read_kind(answer):
+    match = KIND.search(answer)
+    if not match:
+        raise ValueError(answer)
+    return int(match.group(1).lower() == 'dynamic')
+
+def read_variables(answer):
+    if not answer:
+        raise ValueError(answer)
+    return sorted(set(name.strip() for name in VARIABLE.findall(answer)))
+
+def read_number(answer):
+    match = NUMBER.search(answer)
+    if not match:
+        raise ValueError(answer)
+    number = match.group(1).lower()
+    return int(number) if number.isdigit() else NUMBER_WORDS[number]
+
+def read_words(answer):
+    return -1 if NOT_ENGLISH.search(answer) else read_number(answer)
+
+def read_placement(answer):
+    if NOT_APPLICABLE.match(answer):
+        return None
+    placements = {PLACEMENTS[word.lower()] for word in PLACEMENT.findall(answer)}
+    if not placements:
+        raise ValueError(answer)
+    return placements.pop() if len(placements) == 1 else 1  # spread out counts as the middle
+
+def read_steps(answer):
+    return None if NOT_APPLICABLE.match(answer) else read_number(answer)
+
+# (question, reader) for each field of a transform_answers tuple
+READERS = ((0, read_yes_no), (1, read_kind), (1, read_variables), (2, read_words), (3, read_placement),
+           (4, read_steps))
+
+def read_answers(answers):
+    # {field index: value} for the fields that can be read; an answer in a form
+    # none of the readers expect leaves its fields out instead of failing the response
+    fields = {}
+    for i, (question, read) in enumerate(READERS):
+        try:
+            fields[i] = read(answers[question].strip())
+        except (ValueError, IndexError):
+            pass
+    return fields
 
-df = pd.DataFrame(columns=['repo_name', 'repo_path', 'system and user?', 'dynamic?', 'dynamic_vars', 'words', 'beg(0), middle(1), end(2)', 'steps'])
+def transform_answers(answers):
+    # N/A answers to questions 4 and 5 become None
+    fields = read_answers(answers)
+    if len(fields) < len(READERS):
+        raise ValueError(f'unable to transform answers: {answers}')
+    return tuple(fields[i] for i in range(len(READERS)))
 
-for line in lines:
-    for i in range(5):
-        fn, repo_name, repo_path = line.strip()[1:-1].split(', ')
-        fn = fn[1:-1]
-        with open(f'repos/{fn}', 'r') as f:
-            code = f.read()
-            completion = openai.ChatCompletion.create(
-                model='gpt-3.5-turbo',
-                temperature=0.2,
-                messages=[
-                    {'role': 'system', 'content': 'You are a helpful code tracer.'}, 
-                    {'role': 'user', 'content': create_prompt(code)}
-                ]
-            )
-            print(completion.choices[0].message.content)
-    exit(0)
+def consensus(responses, min_agree=2):
+    '''
+    Majority answer per question over the sampled responses of one file, as
+    (answers, agreement, settled). answers is a transform_answers tuple with None
+    where no response could be read, agreement the share of readable responses
+    behind each answer, and settled whether every answer has at least min_agree
+    votes and a strict majority, i.e. whether more samples would be wasted. A
+    tie goes to the answer read first and is never settled.
+    '''
+    votes = [Counter() for _ in READERS]
+    for text in responses:
+        for i, value in read_answers(split_answers(text)).items():
+            votes[i][tuple(value) if isinstance(value, list) else value] += 1
+    answers, shares = [], []
+    settled = True
+    for counter in votes:
+        if not counter:
+            answers.append(None)
+            shares.append(None)
+            settled = False
+            continue
+        (value, count), = counter.most_common(1)
+        total = sum(counter.values())
+        answers.append(list(value) if isinstance(value, tuple) else value)
+        shares.append(count / total)
+        settled = settled and count >= min_agree and count * 2 > total
+    return tuple(answers), shares, settled
+
+def label_columns(answers):
+    return {question.replace(' ', '_'): answer for question, answer in zip(QUESTIONS, answers)}
+
+SYSTEM_PROMPT = 'You are a helpful code tracer.'
+
+def classification_sources(path='repos/repos.txt', token_budget=2000, model='gpt-3.5-turbo', dedup=None, static=None,
+                           agreement_sample=0):
+    # notebooks are reduced to their code cells, and everything larger than the
+    # budget is sliced down to the parts around the LLM calls. With a dedup LSHIndex,
+    # files whose code is a near-duplicate of an earlier one are not sent at all.
+    # With a static dict, files the AST answers with confidence get their answers
+    # there instead, except the first agreement_sample of them, which are sent as well
+    for fn, repo_name, repo_path in read_repos_file(path):
+        code = read_code(f'repos/{fn}')
+        if static is not None:
+            answers, confident = classify_code(code)
+            if confident:
+                static[(repo_name, repo_path)] = answers
+                if len(static) > agreement_sample:
+                    continue
+        if token_budget:
+            code = slice_source(code, token_budget, model)
+        if dedup and dedup.add((repo_name, repo_path), code) != (repo_name, repo_path):
+            continue
+        yield (repo_name, repo_path), code
+
+def classification_jobs(path='repos/repos.txt', token_budget=2000, model='gpt-3.5-turbo', dedup=None, static=None,
+                        agreement_sample=0):
+    for key, code in classification_sources(path, token_budget, model, dedup, static, agreement_sample):
+        yield key, classification_messages(code)
+
+def classification_messages(code):
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': create_prompt(code)}
+    ]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=5, help='most completions requested per file')
+    parser.add_argument('--min-agree', type=int, default=2, metavar='N',
+                        help='stop sampling a file once every answer has N agreeing samples and a majority, '
+                             '0 always takes --samples')
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    parser.add_argument('--temperature', type=float, default=0.2)
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--rpm', type=int, default=3500, help='requests per minute')
+    parser.add_argument('--tpm', type=int, default=90000, help='tokens per minute')
+    parser.add_argument('--cache', default='llm_cache.sqlite', help='on-disk response cache')
+    parser.add_argument('--api-base', help='e.g. a local mock server')
+    parser.add_argument('--token-budget', type=int, default=2000, help='max code tokens per file, 0 sends whole files')
+    parser.add_argument('--dedup', type=float, metavar='THRESHOLD',
+                        help='classify only the first of each group of files with at least this estimated similarity '
+                             '(e.g. 0.9) and give the others its answers')
+    parser.add_argument('--static', action='store_true',
+                        help='answer from the AST where it is certain and only send the other files to the api')
+    parser.add_argument('--agreement', type=int, default=0, metavar='N',
+                        help='with --static, send the first N statically answered files too and report how often the '
+                             'answers agree')
+    parser.add_argument('--pack', type=int, default=0, metavar='TOKENS',
+                        help='send several files per request, up to this many tokens of code, so the instructions '
+                             'and examples are sent once for all of them')
+    parser.add_argument('--pack-files', type=int, default=8, help='most files per packed request')
+    parser.add_argument('--parquet', metavar='DIR', help='also write every answer as parquet under DIR')
+    parser.add_argument('--run', help='parquet partition to write to, defaults to the start time')
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    with open('openai_token', 'r') as f:
+        OPENAI_KEY = f.readline().strip()
+
+    cache = ResponseCache(args.cache)
+    classifier = Classifier(
+        model=args.model, temperature=args.temperature, concurrency=args.concurrency,
+        requests_per_minute=args.rpm, tokens_per_minute=args.tpm, cache=cache,
+        api_key=OPENAI_KEY, api_base=args.api_base,
+    )
+    store = ResultStore(args.parquet, args.run) if args.parquet else None
+    dedup = LSHIndex(args.dedup) if args.dedup else None
+    static = {} if args.static else None
+    compared = []
+    sampled = Counter()
+    agreeing = [[] for _ in READERS]
+
+    def settled(responses):
+        return consensus(responses, args.min_agree)[2]
+
+    def report(repo_name, repo_path, responses, duplicate_of=None):
+        print(f'====={repo_name}/{repo_path}======')
+        if duplicate_of:
+            print(f'(answers of {duplicate_of[0]}/{duplicate_of[1]})')
+        if isinstance(responses, Exception):
+            print(f'unable to classify: {responses}')
+            if store:
+                store.write('answers', {'repo': repo_name, 'path': repo_path, 'model': args.model,
+                                        'error': str(responses)})
+            return None
+        for i, text in enumerate(responses):
+            print(text)
+            if store:
+                store.write('answers', {'repo': repo_name, 'path': repo_path, 'model': args.model,
+                                        'sample': i, 'response': text})
+        answers, shares, _ = consensus(responses, args.min_agree)
+        print(f'(consensus of {len(responses)}) {answers}')
+        print('(agreement) ' + ', '.join('-' if share is None else f'{share:.0%}' for share in shares))
+        if store:
+            store.write('labels', {'repo': repo_name, 'path': repo_path, 'model': args.model,
+                                   'samples': len(responses), **label_columns(answers), 'agreement': shares})
+        return shares
+
+    def report_static(repo_name, repo_path, answers):
+        print(f'====={repo_name}/{repo_path}======')
+        print(f'(static) {answers}')
+        if store:
+            store.write('answers', {'repo': repo_name, 'path': repo_path, 'model': 'static', 'sample': 0,
+                                    'response': json.dumps(answers)})
+            store.write('labels', {'repo': repo_name, 'path': repo_path, 'model': 'static', 'samples': 0,
+                                   **label_columns(answers)})
+
+    def parsed(responses):
+        samples = []
+        for text in responses:
+            try:
+                samples.append(transform_answers(split_answers(text)))
+            except ValueError:
+                pass
+        return samples
+
+    async def run():
+        if packer:
+            sources = classification_sources(token_budget=args.token_budget, model=args.model, dedup=dedup,
+                                             static=static, agreement_sample=args.agreement)
+            results = packer.sample_many(pack(sources, args.pack, args.model, args.pack_files))
+        else:
+            jobs = classification_jobs(token_budget=args.token_budget, model=args.model, dedup=dedup, static=static,
+                                       agreement_sample=args.agreement)
+            results = classifier.sample_many(jobs, args.samples, settled=settled if args.min_agree else None,
+                                             min_samples=args.min_agree)
+        async for (repo_name, repo_path), responses in results:
+            shares = report(repo_name, repo_path, responses)
+            if shares:
+                sampled[len(responses)] += 1
+                for i, share in enumerate(shares):
+                    if share is not None:
+                        agreeing[i].append(share)
+            if static and (repo_name, repo_path) in static and not isinstance(responses, Exception):
+                compared.append((static[(repo_name, repo_path)], parsed(responses)))
+            if dedup:
+                dedup.results[(repo_name, repo_path)] = responses
+        if dedup:
+            # members can turn up after their representative was answered, so they go last
+            for key, rep in dedup.representative.items():
+                if key != rep:
+                    report(*key, dedup.results[rep], duplicate_of=rep)
+        for key, answers in (static or {}).items():
+            report_static(*key, answers)
+
+    packer = None
+    if args.pack:
+        from packing import PackedSampler, pack
+        packer = PackedSampler(classifier, args.samples, settled if args.min_agree else None, args.min_agree)
+
+    stop_metrics = start_metrics(args)
+    try:
+        asyncio.run(run())
+    finally:
+        stop_metrics()
+        cache.close()
+        if store:
+            store.close()
+    if static is not None:
+        print(f'{len(static)} files answered from the AST')
+        if compared:
+            print(f'agreement with the api on {len(compared)} of them:')
+            for question, (share, count) in agreement(compared).items():
+                print(f'  {question:16} {"-" if share is None else f"{share:.0%}"} ({count} files)')
+    print(f'{classifier.calls} api calls')
+    if packer:
+        print(f'{packer.requests} requests, {packer.repacked} packs sent again for files left out, '
+              f'{packer.alone} files sent alone after that')
+    files = sum(sampled.values())
+    if files:
+        print(f'{sum(n * count for n, count in sampled.items()) / files:.2f} samples per file over {files} files '
+              f'({", ".join(f"{count} with {n}" for n, count in sorted(sampled.items()))})')
+        for question, shares in zip(QUESTIONS, agreeing):
+            print(f'  {question:16} {sum(shares) / len(shares):.0%} mean agreement' if shares else f'  {question:16} -')
 
 # for i, line in enumerate(lines):
 #     fn, repo_name, repo_path = line.strip()[1:-1].split(', ')
@@ -321,4 +554,7 @@ for line in lines:
 
 # run multiple times
 # print the template
-# holdout set with different set
\ No newline at end of file
+# holdout set with different set
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import atexit
+import functools
+import http.server
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import random
+import threading
+import time
+
+from analysis import collect_prompts, is_relevant, prompt_statistics
+from parse import download_and_parse, find_openai_chatcompletions_calls, read_repos_file, scan_repo_files
+
+RESULTS = 'benchmarks.jsonl'
+FILLER_BYTES = 46  # average size of one filler line
+
+def synthetic_file(calls=200, chain_depth=20, filler=2000, fstring_ratio=0.5, seed=0):
+    '''
+    Deterministic python source with `calls` ChatCompletion.create calls, each fed
+    by an assignment chain `chain_depth` long that starts at sys.argv, plus `filler`
+    unrelated assignments to grow the file.
+    '''
+    rng = random.Random(seed)
+    lines = ['import openai', 'import sys', '']
+    for i in range(filler):
+        lines.append(f'filler_{i} = {rng.randint(0, 1000)} + len("{"x" * rng.randint(0, 40)}")')
+    for c in range(calls):
+        lines.append(f'v_{c}_0 = sys.argv[{c % 5 + 1}]')
+        for d in range(1, chain_depth):
+            if rng.random() < fstring_ratio:
+                lines.append(f'v_{c}_{d} = f"step {d}: {{v_{c}_{d - 1}}} and more words"')
+            else:
+                lines.append(f'v_{c}_{d} = v_{c}_{d - 1} + " step {d}"')
+        lines.append(f'messages_{c} = [{{"role": "user", "content": v_{c}_{chain_depth - 1}}}]')
+        lines.append(f'openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=messages_{c})')
+    return '\n'.join(lines) + '\n'
+
+def filler_for(file_size, calls, chain_depth):
+    return max(0, (file_size - calls * (40 * chain_depth + 50)) // FILLER_BYTES)
+
+def generate_corpus(directory, files=200, file_size=20000, calls=5, chain_depth=10, fstring_ratio=0.5, seed=0):
+    '''
+    Writes `files` synthetic sources of roughly file_size bytes to directory,
+    plus a repos.txt in the format analyse_code.py writes, and returns their
+    total size. The same arguments always give byte-identical files.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    filler = filler_for(file_size, calls, chain_depth)
+    total = 0
+    with open(os.path.join(directory, 'repos.txt'), 'w') as repos:
+        for i in range(files):
+            code = synthetic_file(calls, chain_depth, filler, fstring_ratio, seed * 1000003 + i)
+            fn = f'bench_r{i}_f{i}.py'
+            with open(os.path.join(directory, fn), 'w') as f:
+                f.write(code)
+            total += len(code)
+            repos.write(str((fn, f'bench/r{i}', f'f{i}.py')) + '\n')
+    return total
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and the peak over the whole process, which is why
+    # bench_all runs every benchmark in its own process; children only count once reaped
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def record(args, name, files, size, elapsed, **extra):
+    result = {
+        'benchmark': name,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('command', 'func', 'results')},
+        'files': files,
+        'mb': round(size / 1e6, 3),
+        'seconds': round(elapsed, 3),
+        'files_per_s': round(files / elapsed, 1),
+        'mb_per_s': round(size / 1e6 / elapsed, 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        **extra,
+    }
+    print(f"{name}: {files} files, {result['mb']} MB in {result['seconds']}s, {result['files_per_s']} files/s, "
+          f"{result['mb_per_s']} MB/s, peak rss of its process {result['peak_rss_mb']} MB")
+    if args.results:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    return result
+
+CORPUS_ARGS = ('files', 'file_size', 'calls', 'chain_depth', 'fstring_ratio', 'seed')
+
+@functools.lru_cache()
+def generated_corpus(*corpus_args):
+    root = tempfile.mkdtemp(prefix='bench_corpus_')
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return root, generate_corpus(os.path.join(root, 'repos'), *corpus_args)
+
+def corpus(args):
+    '''(root, total bytes) of the corpus for args, generated once per run under root/repos.'''
+    return generated_corpus(*(getattr(args, key) for key in CORPUS_ARGS))
+
+def parsed_results(root, workers=1):
+    # scan_repo_files reads repos/<fn> relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        return [result for _, result, _ in scan_repo_files(read_repos_file(), workers, prefilter=None)]
+    finally:
+        os.chdir(cwd)
+
+def bench_finder(args):
+    code = synthetic_file(args.calls, args.chain_depth, args.filler, args.fstring_ratio, args.seed)
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        interactions = find_openai_chatcompletions_calls(code)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'finder: {len(code) / 1e6:.2f} MB, {args.calls} calls, {len(interactions)} interactions, '
+          f'best of {args.repeat}: {best:.3f}s ({len(code) / 1e6 / best:.2f} MB/s)')
+    record(args, 'finder', 1, len(code), best, interactions=len(interactions))
+
+def bench_parse(args):
+    root, size = corpus(args)
+    start = time.perf_counter()
+    results = parsed_results(root, args.workers)
+    elapsed = time.perf_counter() - start
+    record(args, 'parse', args.files, size, elapsed, with_calls=sum(1 for result in results if result and result['calls']))
+
+def bench_analysis(args):
+    root, _ = corpus(args)
+    results = [result for result in parsed_results(root, args.workers) if result and is_relevant(result)]
+    size = sum(len(call) for result in results for call in result['create_calls'])
+    start = time.perf_counter()
+    prompts = collect_prompts((result['url'], result['create_calls']) for result in results)
+    prompt_statistics(sorted(prompts, key=len, reverse=True))
+    elapsed = time.perf_counter() - start
+    record(args, 'analysis', len(results), size, elapsed, prompts=len(prompts))
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def bench_e2e(args):
+    '''Downloads the corpus from a local http server and parses it, as parse.py j does.'''
+    root, size = corpus(args)
+    directory = os.path.join(root, 'repos')
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fns = sorted(fn for fn in os.listdir(directory) if fn.endswith('.py'))
+    urls = [f'http://127.0.0.1:{server.server_port}/{fn}' for fn in fns]
+
+    async def run():
+        return [result async for _, result, _ in download_and_parse(urls, args.concurrency, prefilter=None)]
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    record(args, 'e2e', len(urls), size, elapsed, parsed=sum(1 for result in results if result))
+
+def show_history(args):
+    if not os.path.exists(args.results):
+        print(f'no results in {args.results}')
+        return
+    with open(args.results) as f:
+        rows = [json.loads(line) for line in f]
+    if args.benchmark:
+        rows = [row for row in rows if row['benchmark'] == args.benchmark]
+    for row in rows[-args.last:]:
+        print(f"{row['time']}  {row['commit'] or '-':>8}  {row['benchmark']:<8}  {row['files']:>6} files  "
+              f"{row['mb']:>8} MB  {row['files_per_s']:>8} files/s  {row['mb_per_s']:>7} MB/s  {row['peak_rss_mb']:>7} MB rss")
+
+def write_corpus(args):
+    size = generate_corpus(args.directory, *(getattr(args, key) for key in CORPUS_ARGS))
+    print(f'{args.files} files, {size / 1e6:.2f} MB written to {args.directory}')
+
+BENCHMARKS = {'parse': bench_parse, 'analysis': bench_analysis, 'e2e': bench_e2e}
+
+def bench_all(args):
+    '''
+    Runs one benchmark in this process, or each of several in a fresh one so
+    that the peak rss recorded for a benchmark is its own and not the largest
+    of the ones that ran before it.
+    '''
+    names = args.only or list(BENCHMARKS)
+    if len(names) == 1:
+        BENCHMARKS[names[0]](args)
+        return
+    options = [f"--{key.replace('_', '-')}={getattr(args, key)}" for key in CORPUS_ARGS + ('workers', 'concurrency')]
+    for name in names:
+        subprocess.run([sys.executable, os.path.abspath(__file__), f'--results={args.results}', 'suite', *options,
+                        '--only', name], check=True)
+
+def add_corpus_arguments(parser):
+    parser.add_argument('--files', type=int, default=200, help='files in the synthetic corpus')
+    parser.add_argument('--file-size', type=int, default=20000, help='approximate bytes per file')
+    parser.add_argument('--calls', type=int, default=5, help='ChatCompletion calls per file')
+    parser.add_argument('--chain-depth', type=int, default=10, help='assignments between sys.argv and each call')
+    parser.add_argument('--fstring-ratio', type=float, default=0.5, help='share of chain assignments that are f-strings')
+    parser.add_argument('--seed', type=int, default=0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks on deterministic synthetic corpora; results are appended to '
+                                                 f'{RESULTS} so runs can be compared over time.')
+    parser.add_argument('--results', default=RESULTS, help='jsonl file results are appended to, empty to not store them')
+    commands = parser.add_subparsers(dest='command')
+
+    finder = commands.add_parser('finder', help='Finder on one large file')
+    finder.add_argument('--calls', type=int, default=200)
+    finder.add_argument('--chain-depth', type=int, default=20)
+    finder.add_argument('--filler', type=int, default=2000)
+    finder.add_argument('--fstring-ratio', type=float, default=0.5)
+    finder.add_argument('--seed', type=int, default=0)
+    finder.add_argument('--repeat', type=int, default=3)
+    finder.set_defaults(func=bench_finder)
+
+    suite = commands.add_parser('suite', help='parse, analysis and end-to-end runs over a generated corpus')
+    add_corpus_arguments(suite)
+    suite.add_argument('--workers', type=int, default=1, help='processes for the parse scan')
+    suite.add_argument('--concurrency', type=int, default=32, help='parallel downloads for e2e')
+    suite.add_argument('--only', action='append', choices=sorted(BENCHMARKS), help='run only this benchmark, may be repeated')
+    suite.set_defaults(func=bench_all)
+
+    generate = commands.add_parser('generate', help='write a synthetic corpus to a directory')
+    generate.add_argument('directory')
+    add_corpus_arguments(generate)
+    generate.set_defaults(func=write_corpus)
+
+    history = commands.add_parser('history', help='show stored results')
+    history.add_argument('--benchmark', help='only this benchmark')
+    history.add_argument('--last', type=int, default=20)
+    history.set_defaults(func=show_history)
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        return
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+class BlobCache:
+    '''
+    On-disk cache of fetched files. Entries are keyed by url and point at a blob
+    named by the sha256 of its content, so forks sharing a file store it once.
+    The etag of each entry is kept for If-None-Match revalidation and the least
+    recently used entries are evicted once the blobs exceed max_bytes.
+    '''
+    def __init__(self, path='cache', max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(path, 'blobs'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                etag TEXT,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_sha256 ON entries (sha256);
+            CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+        ''')
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.path, 'blobs', sha256[:2], sha256)
+
+    def lookup(self, url):
+        '''Returns (sha256, etag) for a cached url, or None.'''
+        row = self.db.execute('SELECT sha256, etag FROM entries WHERE url = ?', (url,)).fetchone()
+        return row
+
+    def read(self, url):
+        row = self.lookup(url)
+        if row is None:
+            return None
+        try:
+            with open(self._blob_path(row[0]), 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            self.db.execute('DELETE FROM entries WHERE url = ?', (url,))
+            return None
+        self.db.execute('UPDATE entries SET last_access = ? WHERE url = ?', (time.time(), url))
+        return body
+
+    def put(self, url, body, etag=None):
+        sha256 = hashlib.sha256(body).hexdigest()
+        blob_path = self._blob_path(sha256)
+        if self.db.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone() is None:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f'{blob_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, blob_path)
+            self.db.execute('INSERT INTO blobs (sha256, size) VALUES (?, ?)', (sha256, len(body)))
+
+        old = self.lookup(url)
+        self.db.execute(
+            'INSERT OR REPLACE INTO entries (url, sha256, etag, last_access) VALUES (?, ?, ?, ?)',
+            (url, sha256, etag, time.time())
+        )
+        if old is not None and old[0] != sha256:
+            self._drop_unreferenced(old[0])
+        self.evict()
+        self.db.commit()
+        return sha256
+
+    def _drop_unreferenced(self, sha256):
+        if self.db.execute('SELECT 1 FROM entries WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone():
+            return
+        self.db.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+        try:
+            os.remove(self._blob_path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        for url, sha256 in self.db.execute('SELECT url, sha256 FROM entries ORDER BY last_access').fetchall():
+            self.db.execute('DELETE FROM entries WHERE url = ?', (url,))
+            size = self.db.execute('SELECT size FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+            self._drop_unreferenced(sha256)
+            if size and not self.db.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone():
+                total -= size[0]
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from collections import deque
+
+import openai
+
+from metrics import LLM_CACHE_HITS, LLM_REQUESTS, LLM_SECONDS, LLM_TOKENS
+
+try:
+    import tiktoken
+except ImportError:  # optional, token counts fall back to estimate_tokens
+    tiktoken = None
+
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIConnectionError,
+)
+
+def estimate_tokens(text):
+    # ~4 characters per token for English and code, good enough for rate limiting
+    return len(text) // 4 + 1
+
+_encodings = {}
+
+def count_tokens(text, model='gpt-3.5-turbo'):
+    if tiktoken is None:
+        return estimate_tokens(text)
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding('cl100k_base')
+    return len(_encodings[model].encode(text, disallowed_special=()))
+
+class TokenBucket:
+    '''Allows `per_minute` units per minute, in bursts of at most `per_minute`.'''
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def drain(self, seconds):
+        # a 429 means the server-side budget is spent, so stop everyone for a while
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.updated = time.monotonic()
+
+class ResponseCache:
+    '''
+    Completions on disk, keyed by (model, temperature, prompt sha256, sample
+    index). Every response is committed as soon as it arrives, so reruns and
+    crashed runs never pay for the same call twice.
+    '''
+    def __init__(self, path='llm_cache.sqlite'):
+        self.db = sqlite3.connect(path)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                model TEXT NOT NULL,
+                temperature REAL NOT NULL,
+                prompt_sha256 TEXT NOT NULL,
+                sample INTEGER NOT NULL,
+                response TEXT NOT NULL,
+                PRIMARY KEY (model, temperature, prompt_sha256, sample)
+            )
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def get(self, model, temperature, prompt_sha256, sample):
+        row = self.db.execute(
+            'SELECT response FROM responses WHERE model = ? AND temperature = ? AND prompt_sha256 = ? AND sample = ?',
+            (model, temperature, prompt_sha256, sample)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, model, temperature, prompt_sha256, sample, response):
+        self.db.execute(
+            'INSERT OR REPLACE INTO responses (model, temperature, prompt_sha256, sample, response) VALUES (?, ?, ?, ?, ?)',
+            (model, temperature, prompt_sha256, sample, response)
+        )
+        self.db.commit()
+
+class Classifier:
+    '''
+    Async ChatCompletion client with a concurrency cap, request and token
+    buckets, backoff on 429s and transient errors, and an optional ResponseCache.
+    api_base can point at a local mock server.
+    '''
+    def __init__(self, model='gpt-3.5-turbo', temperature=0.2, concurrency=8, requests_per_minute=3500,
+                 tokens_per_minute=90000, max_tokens=256, retries=6, backoff=1.0, cache=None,
+                 api_key=None, api_base=None):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.api_key = api_key
+        self.api_base = api_base
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.calls = 0
+
+    def _retry_delay(self, attempt, error):
+        retry_after = (getattr(error, 'headers', None) or {}).get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * 2 ** attempt
+
+    async def complete(self, messages, sample=0, max_tokens=None):
+        prompt_sha256 = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+        if self.cache:
+            cached = self.cache.get(self.model, self.temperature, prompt_sha256, sample)
+            if cached is not None:
+                LLM_CACHE_HITS.inc(model=self.model)
+                return cached
+
+        max_tokens = max_tokens or self.max_tokens
+        cost = sum(estimate_tokens(message['content']) for message in messages) + max_tokens
+        for attempt in range(self.retries + 1):
+            async with self.semaphore:
+                await self.requests.acquire()
+                await self.tokens.acquire(cost)
+                start = time.monotonic()
+                try:
+                    self.calls += 1
+                    completion = await openai.ChatCompletion.acreate(
+                        model=self.model,
+                        temperature=self.temperature,
+                        max_tokens=max_tokens,
+                        messages=messages,
+                        api_key=self.api_key,
+                        api_base=self.api_base,
+                    )
+                    LLM_SECONDS.observe(time.monotonic() - start, model=self.model)
+                    LLM_REQUESTS.inc(model=self.model, outcome='ok')
+                    usage = completion.get('usage') or {}
+                    LLM_TOKENS.inc(usage.get('prompt_tokens', 0), model=self.model, direction='sent')
+                    LLM_TOKENS.inc(usage.get('completion_tokens', 0), model=self.model, direction='received')
+                    break
+                except RETRY_ERRORS as e:
+                    outcome = 'rate_limited' if isinstance(e, openai.error.RateLimitError) else 'retryable_error'
+                    LLM_REQUESTS.inc(model=self.model, outcome=outcome)
+                    if attempt == self.retries:
+                        raise
+                    delay = self._retry_delay(attempt, e)
+                    if isinstance(e, openai.error.RateLimitError):
+                        # the buckets make every caller wait, not just this one
+                        self.requests.drain(delay)
+                        self.tokens.drain(delay)
+                        delay = 0
+            await asyncio.sleep(delay)
+
+        text = completion.choices[0].message.content
+        if self.cache:
+            self.cache.put(self.model, self.temperature, prompt_sha256, sample, text)
+        return text
+
+    async def sample(self, messages, samples):
+        return await asyncio.gather(*(self.complete(messages, i) for i in range(samples)))
+
+    async def sample_until(self, messages, samples, settled, min_samples=1):
+        '''
+        Up to `samples` completions: min_samples of them at once, then one at a
+        time until settled(responses) holds. Sample indexes are the same as
+        sample()'s, so both share the cache.
+        '''
+        responses = list(await self.sample(messages, min(min_samples, samples)))
+        while len(responses) < samples and not settled(responses):
+            responses.append(await self.complete(messages, len(responses)))
+        return responses
+
+    async def sample_many(self, jobs, samples, window=None, settled=None, min_samples=1):
+        '''
+        Runs sample() over an iterable of (key, messages) with a bounded number
+        of jobs in flight, yielding (key, responses or exception) in input order.
+        With settled, each job stops early as in sample_until().
+        '''
+        async def run(messages):
+            try:
+                if settled:
+                    return await self.sample_until(messages, samples, settled, min_samples)
+                return await self.sample(messages, samples)
+            except Exception as e:
+                return e
+
+        window = window or self.concurrency * 4
+        pending = deque()
+        for key, messages in jobs:
+            pending.append((key, asyncio.ensure_future(run(messages))))
+            if len(pending) >= window:
+                key, task = pending.popleft()
+                yield key, await task
+        while pending:
+            key, task = pending.popleft()
+            yield key, await task
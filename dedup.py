@@ -0,0 +1,96 @@
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+TOKEN = re.compile(r'\w+|[^\w\s]')
+PRIME = (1 << 31) - 1  # keeps a * hash + b inside uint64
+CHUNK = 1 << 13  # shingles hashed at once, num_perm x CHUNK values in memory
+
+def lsh_bands(threshold, num_perm):
+    '''
+    (bands, rows) whose S-curve (1 / bands) ** (1 / rows) crosses closest to
+    threshold: pairs above it almost always share a bucket, pairs below rarely do.
+    '''
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+class MinHasher:
+    '''MinHash signatures over k-token shingles, with whitespace and layout ignored.'''
+    def __init__(self, num_perm=128, shingle=5, seed=1):
+        self.shingle = shingle
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)[:, None]
+
+    def sketch(self, text):
+        '''(exact digest, signature) of a text, cheap to send back from a worker process.'''
+        tokens = TOKEN.findall(text)
+        digest = hashlib.sha256('\0'.join(tokens).encode()).hexdigest()
+        return digest, self.signature(tokens)
+
+    def signature(self, tokens):
+        hashes = np.array([zlib.crc32(token.encode()) for token in tokens] or [0], dtype=np.uint64)
+        k = min(self.shingle, len(hashes))
+        # rolling combination of k token hashes, one value per shingle
+        shingles = np.zeros(len(hashes) - k + 1, dtype=np.uint64)
+        for i in range(k):
+            shingles = (shingles * np.uint64(1000003) + hashes[i:len(hashes) - k + 1 + i]) % np.uint64(PRIME)
+        signature = np.full(len(self.a), PRIME, dtype=np.uint64)
+        for start in range(0, len(shingles), CHUNK):
+            chunk = shingles[start:start + CHUNK]
+            np.minimum(signature, ((self.a * chunk + self.b) % np.uint64(PRIME)).min(axis=1), out=signature)
+        return signature
+
+class LSHIndex:
+    '''
+    Groups texts into near-duplicate clusters. The first text of a cluster is
+    its representative, and a later text joins it when they are identical after
+    tokenisation or their estimated Jaccard similarity is at least threshold.
+    Only representatives are indexed, so every member is close to its
+    representative, which is what reusing the representative's result needs.
+    '''
+    def __init__(self, threshold=0.9, num_perm=128, shingle=5, seed=1):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle, seed)
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        self.exact = {}
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = {}
+        self.representative = {}
+        self.results = {}  # representative -> whatever the caller computed for it
+
+    def add(self, key, text=None, sketch=None):
+        '''Adds key and returns the representative of its cluster, key itself if new.'''
+        digest, signature = sketch or self.hasher.sketch(text)
+        if digest in self.exact:
+            rep = self.exact[digest]
+        else:
+            rep = self.query(signature)
+            if rep is None:
+                rep = key
+                self.signatures[key] = signature
+                for band, bucket in zip(self.bands_of(signature), self.buckets):
+                    bucket.setdefault(band, []).append(key)
+            self.exact[digest] = rep
+        self.representative[key] = rep
+        return rep
+
+    def bands_of(self, signature):
+        for i in range(self.bands):
+            yield signature[i * self.rows:(i + 1) * self.rows].tobytes()
+
+    def query(self, signature):
+        seen = set()
+        for band, bucket in zip(self.bands_of(signature), self.buckets):
+            for candidate in bucket.get(band, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                    return candidate
+        return None
+
+    def clusters(self):
+        return len(self.signatures)
@@ -0,0 +1,178 @@
+import asyncio
+import time
+from collections import deque, namedtuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from metrics import HTTP_BYTES, HTTP_CACHE_HITS, HTTP_REQUESTS, HTTP_RETRIES, HTTP_SECONDS
+
+RAW_BASE = 'https://raw.githubusercontent.com'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+Response = namedtuple('Response', ['url', 'status', 'body', 'headers', 'cached'], defaults=(False,))
+
+class FetchError(Exception):
+    pass
+
+class Fetcher:
+    '''
+    Shared download engine: one pooled aiohttp session, a global concurrency cap,
+    a per-host request rate and retries with exponential backoff. With a
+    cache.BlobCache attached, known urls are revalidated with If-None-Match
+    (or served straight from disk when revalidate is False).
+
+        async with Fetcher(concurrency=32, cache=BlobCache()) as fetcher:
+            res = await fetcher.fetch(url)
+    '''
+    def __init__(self, concurrency=32, per_host_rate=None, retries=4, backoff=0.5, timeout=60, headers=None,
+                 retry_statuses=RETRY_STATUSES, cache=None, revalidate=True):
+        self.concurrency = concurrency
+        self.per_host_rate = per_host_rate  # requests per second per host, None for no limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.retry_statuses = retry_statuses
+        self.cache = cache
+        self.revalidate = revalidate
+        self.session = None
+        self._semaphore = None
+        self._next_slot = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def _throttle(self, host):
+        if not self.per_host_rate:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot.get(host, now))
+        self._next_slot[host] = slot + 1 / self.per_host_rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _retry_delay(self, attempt, res=None):
+        if res is not None and 'Retry-After' in res.headers:
+            try:
+                return float(res.headers['Retry-After'])
+            except ValueError:
+                pass
+        return self.backoff * 2 ** attempt
+
+    async def fetch(self, url, headers=None):
+        cached = self.cache.lookup(url) if self.cache else None
+        if cached is None:
+            res = await self._get(url, headers)
+        else:
+            if not self.revalidate:
+                body = self.cache.read(url)
+                if body is not None:
+                    HTTP_CACHE_HITS.inc(host=urlsplit(url).netloc)
+                    return Response(url, 200, body, {}, True)
+            conditional = dict(headers or {})
+            if cached[1]:
+                conditional['If-None-Match'] = cached[1]
+            res = await self._get(url, conditional)
+            if res.status == 304:
+                body = self.cache.read(url)
+                if body is None:  # blob went missing, read() dropped the entry
+                    return await self.fetch(url, headers)
+                HTTP_CACHE_HITS.inc(host=urlsplit(url).netloc)
+                return Response(url, 200, body, res.headers, True)
+        if self.cache and res.status == 200:
+            self.cache.put(url, res.body, res.headers.get('ETag'))
+        return res
+
+    async def _get(self, url, headers=None, path=None):
+        # with a path, a 200 body is streamed to that file and the response carries no body
+        host = urlsplit(url).netloc
+        options = {'timeout': aiohttp.ClientTimeout(total=None, sock_read=self.timeout)} if path else {}
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            async with self._semaphore:
+                await self._throttle(host)
+                start = time.monotonic()
+                try:
+                    async with self.session.get(url, headers=headers, **options) as res:
+                        if path is None:
+                            body = await res.read()
+                            size = len(body)
+                        else:
+                            body, size = None, await save_stream(res, path) if res.status == 200 else 0
+                        response = Response(url, res.status, body, res.headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    HTTP_REQUESTS.inc(host=host, status='error')
+                    if last:
+                        raise FetchError(f'{url}: {e!r}') from e
+                    response = None
+                else:
+                    HTTP_SECONDS.observe(time.monotonic() - start, host=host)
+                    HTTP_REQUESTS.inc(host=host, status=response.status)
+                    HTTP_BYTES.inc(size, host=host)
+            if response is not None and (response.status not in self.retry_statuses or last):
+                return response
+            HTTP_RETRIES.inc(host=host)
+            await asyncio.sleep(self._retry_delay(attempt, response))
+
+    async def download(self, url, path, headers=None):
+        '''
+        Streams the body of url to path, for files too large to hold in memory such
+        as repository archives. Only the read timeout applies, not the total one,
+        and the cache is not used.
+        '''
+        return await self._get(url, headers, path)
+
+    async def fetch_first(self, urls, headers=None):
+        # probes each candidate in turn and keeps the body of the first hit, so
+        # branch resolution (main, then master) never downloads a file twice
+        for url in urls:
+            try:
+                res = await self.fetch(url, headers)
+            except FetchError:
+                continue
+            if res.status == 200:
+                return res
+        return None
+
+    async def fetch_many(self, jobs, window=None):
+        '''
+        Runs fetch_first over an iterable of url lists with a bounded number of
+        jobs in flight, yielding (job, response or None) in input order.
+        '''
+        window = window or self.concurrency * 4
+        pending = deque()
+        for job in jobs:
+            urls = [job] if isinstance(job, str) else job
+            pending.append((job, asyncio.ensure_future(self.fetch_first(urls))))
+            if len(pending) >= window:
+                job, task = pending.popleft()
+                yield job, await task
+        while pending:
+            job, task = pending.popleft()
+            yield job, await task
+
+async def save_stream(res, path, chunk_size=1 << 16):
+    size = 0
+    with open(path, 'wb') as f:
+        async for chunk in res.content.iter_chunked(chunk_size):
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+def add_arguments(parser):
+    parser.add_argument('--per-host-rate', type=float, metavar='N', help='at most N requests per second to any one host')
+
+def raw_url_candidates(repo_name, repo_path, raw_base=RAW_BASE, branches=('main', 'master')):
+    return [f'{raw_base}/{repo_name}/{branch}/{repo_path}' for branch in branches]
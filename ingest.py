@@ -0,0 +1,142 @@
+import codecs
+import json
+import mmap
+import re
+from bisect import bisect_right
+from contextlib import contextmanager
+from io import BytesIO
+from tokenize import detect_encoding
+
+try:
+    import ijson
+except ImportError:  # optional, notebooks are then read with json.load
+    ijson = None
+
+SOURCE_SUFFIXES = ('.py', '.ipynb')
+NON_ASCII = re.compile(rb'[\x80-\xff]')
+LINE_END = re.compile(rb'\r\n|\r|\n')
+CHUNK = 1 << 20
+CELL_PREFIXES = ('cells.item', 'worksheets.item.cells.item')  # nbformat 4, nbformat 3
+SHELL_ASSIGNMENT = re.compile(r'\s*[\w, ]+=\s*[!%]')  # files = !ls
+
+@contextmanager
+def map_file(path):
+    '''
+    Yields the file's bytes as a read-only mmap (b'' for an empty file), so the
+    prefilter, ast.parse and Finder all read the page cache instead of a copy.
+    Nothing taken from it may be used after the block.
+    '''
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            yield b''
+            return
+        with data:
+            yield data
+
+def source_encoding(data):
+    # PEP 263: a BOM or a coding cookie in the first two lines, utf-8 otherwise
+    first_lines = LINE_END.finditer(data)
+    end = 0
+    for _ in range(2):
+        match = next(first_lines, None)
+        end = match.end() if match else len(data)
+    try:
+        return detect_encoding(BytesIO(data[:end]).readline)[0]
+    except SyntaxError:  # unknown codec, or a cookie that contradicts the BOM
+        return None
+
+def is_utf8(data):
+    # checked in pieces so that a large file is never decoded into one str
+    if not NON_ASCII.search(data):
+        return True
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for start in range(0, len(data), CHUNK):
+            decoder.decode(data[start:start + CHUNK])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def decode_source(data):
+    '''
+    Python source in the form ast.parse and Finder take it. utf-8 sources, which
+    is nearly all of them, are returned as they are, bytes or mmap, and never
+    become a str. Sources with another coding cookie are decoded with it, and
+    bytes that do not decode are replaced, so the file is still analysed
+    instead of being dropped.
+    '''
+    encoding = source_encoding(data)
+    if encoding == 'utf-8-sig':
+        data, encoding = data[3:], 'utf-8'
+    if encoding == 'utf-8' and is_utf8(data):
+        return data
+    return str(data, encoding or 'utf-8', errors='replace')
+
+def source_text(source):
+    '''A decode_source result as a str.'''
+    return source if isinstance(source, str) else str(source, 'utf-8')
+
+def notebook_cells(f):
+    # (cell_type, source) per cell of a notebook opened in binary mode; with ijson
+    # the json is streamed and only the cell types and sources are kept
+    if ijson is None:
+        notebook = json.load(f)
+        cells = notebook.get('cells')
+        if cells is None:
+            cells = [cell for sheet in notebook.get('worksheets', []) for cell in sheet.get('cells', [])]
+        for cell in cells:
+            source = cell.get('source', cell.get('input', ''))
+            yield cell.get('cell_type'), ''.join(source) if isinstance(source, list) else source
+        return
+    cell_type, source = None, []
+    for prefix, event, value in ijson.parse(f):
+        if prefix in CELL_PREFIXES:
+            if event == 'start_map':
+                cell_type, source = None, []
+            elif event == 'end_map':
+                yield cell_type, ''.join(source)
+        elif event == 'string':
+            owner, _, key = prefix.removesuffix('.item').rpartition('.')
+            if owner not in CELL_PREFIXES:
+                continue  # outputs, metadata and markdown attachments
+            if key in ('source', 'input'):
+                source.append(value)
+            elif key == 'cell_type':
+                cell_type = value
+
+def clean_cell(source):
+    # IPython magics and shell lines are commented out rather than dropped, so line numbers stay put
+    lines = source.split('\n')
+    if lines[0].startswith('%%'):  # cell magic, the whole cell is not python
+        return ['# ' + line for line in lines]
+    return ['# ' + line if line.lstrip().startswith(('%', '!')) or SHELL_ASSIGNMENT.match(line) else line
+            for line in lines]
+
+def read_notebook(f):
+    '''
+    Code cells of a notebook as one module, and the cell map: (first line, cell
+    index) for each code cell, see cell_position. Memory depends on the size of
+    the code, not of the notebook, since outputs are never kept.
+    '''
+    parts = []
+    cells = []
+    line = 1
+    for index, (cell_type, source) in enumerate(notebook_cells(f)):
+        if cell_type != 'code':
+            continue
+        lines = clean_cell(source)
+        cells.append((line, index))
+        parts.append('\n'.join(lines))
+        line += len(lines) + 1  # cells are separated by a blank line
+    return '\n\n'.join(parts) + '\n', cells
+
+def cell_position(cells, line):
+    '''(cell index, line within the cell) of a line of read_notebook's module.'''
+    i = bisect_right([first for first, _ in cells], line) - 1
+    if i < 0:
+        return None, line
+    first, index = cells[i]
+    return index, line - first + 1
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+from collections import OrderedDict, defaultdict
+
+from analysis import load_parse_results
+from ingest import decode_source, map_file
+from parse import Finder, read_repos_file, repo_url, run_tasks, save_results_to_json
+from sandbox import SandboxPool, add_arguments as add_sandbox_arguments, open_quarantine, options as sandbox_options
+from slicer import is_input_source
+
+PARAMETER_ORIGIN = re.compile(r"'(\w+)' originates as a parameter in function '(\w+)'")
+FUNCTIONS = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+def module_stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def imported_names(tree):
+    # last components of imported modules plus names imported from them, enough to
+    # tell which files of the repo a file can call into
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[-1] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.module:
+                names.add(node.module.split('.')[-1])
+            names.update(alias.name for alias in node.names)
+    return names
+
+def function_calls(tree):
+    # (call, innermost enclosing function or None) for every call in the tree
+    stack = [(tree, None)]
+    while stack:
+        node, function = stack.pop()
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.Call):
+                yield child, function
+            stack.append((child, child if isinstance(child, FUNCTIONS) else function))
+
+def called_name(call):
+    func = call.func
+    return func.id if isinstance(func, ast.Name) else getattr(func, 'attr', None)
+
+def input_sources(node):
+    # outermost argv, input() or file read expressions in node
+    if is_input_source(node):
+        yield node
+        return
+    for child in ast.iter_child_nodes(node):
+        yield from input_sources(child)
+
+def argument_for(call, function, parameter):
+    # the expression a call passes for one parameter, None when it is left to its default
+    params = [arg.arg for arg in function.args.posonlyargs + function.args.args]
+    for keyword in call.keywords:
+        if keyword.arg == parameter:
+            return keyword.value
+    if parameter not in params:
+        return None
+    index = params.index(parameter)
+    if isinstance(call.func, ast.Attribute) and params and params[0] in ('self', 'cls'):
+        index -= 1  # bound method, self is not in the call
+    args = call.args
+    if index < 0 or index >= len(args) or any(isinstance(arg, ast.Starred) for arg in args[:index + 1]):
+        return None
+    return args[index]
+
+class SourceFile:
+    def __init__(self, entry, tree, finder, position=0):
+        self.entry = entry
+        self.position = position
+        self.path = entry[2]
+        self.stem = module_stem(entry[2])
+        self.tree = tree
+        self.finder = finder
+        self.imports = imported_names(tree)
+        # (function, parameter) pairs a prompt comes from: those Finder traced it back
+        # to, and parameters read by the assignments on its trace, where Finder stops
+        self.prompt_parameters = []
+        for line, node in zip(finder.relevant_interactions, finder.interaction_nodes):
+            match = PARAMETER_ORIGIN.fullmatch(line)
+            if match and isinstance(node, FUNCTIONS):
+                self.prompt_parameters.append((node, match.group(1)))
+            elif isinstance(node, ast.Assign):
+                self.prompt_parameters += [(finder.parameter_functions[name.id], name.id) for name in ast.walk(node.value)
+                                           if isinstance(name, ast.Name) and name.id in finder.parameter_functions]
+        self.prompt_parameters = list(dict.fromkeys(self.prompt_parameters))
+
+class RepoIndex:
+    '''
+    Symbol index and call graph of one repository, built in one pass over its
+    files. A prompt that Finder traces back to a function parameter is followed
+    through every call site of the function into the caller, and from there up
+    through the caller's own parameters until it reaches assignments, argv,
+    input() or file reads. The summary of each (function, parameter) is
+    computed once and shared by every trace that reaches it. With a SandboxPool
+    the files are parsed in its workers, and files that hang, run out of memory
+    or crash one are quarantined and left out of the graph, as are files
+    already in the quarantine.
+    '''
+    def __init__(self, entries, pool=None, quarantine=None):
+        self.files = []
+        self.by_entry = {}
+        self.definitions = defaultdict(list)  # name -> [(file, function)]
+        self.call_sites = defaultdict(list)  # name -> [(file, call, enclosing function)]
+        self.summaries = {}
+        entries = [entry for entry in entries if not (quarantine and f'repos/{entry[0]}' in quarantine)]
+        for entry, (failure, loaded) in zip(entries, run_tasks(pool, self.load, entries)):
+            if failure and quarantine:
+                quarantine.add(f'repos/{entry[0]}', failure, url=repo_url(entry))
+            elif loaded:
+                self.add(SourceFile(entry, *loaded, position=len(self.files)))
+
+    @staticmethod
+    def load(entry):
+        path = f'repos/{entry[0]}'
+        try:
+            with map_file(path) as data:
+                source = decode_source(data)
+                if not isinstance(source, str):
+                    source = bytes(source)  # the index outlives the mmap
+            tree = ast.parse(source)
+            finder = Finder(source)
+            finder.visit(tree)
+        except Exception:  # missing or unparsable files have no part in the graph
+            return None
+        return tree, finder
+
+    def add(self, source):
+        self.files.append(source)
+        self.by_entry[source.entry] = source
+        for node in ast.walk(source.tree):
+            if isinstance(node, FUNCTIONS):
+                self.definitions[node.name].append((source, node))
+        for call, function in function_calls(source.tree):
+            name = called_name(call)
+            if name:
+                self.call_sites[name].append((source, call, function))
+
+    def callers(self, source, function):
+        # call sites that can reach function: in its own file, in files importing its
+        # module, or anywhere when no other function in the repo has its name
+        unique = len(self.definitions[function.name]) == 1
+        sites = [(caller, call, enclosing) for caller, call, enclosing in self.call_sites[function.name]
+                 if caller is source or source.stem in caller.imports or unique]
+        return sorted(sites, key=lambda site: (site[0].position, site[1].lineno, site[1].col_offset))
+
+    def summary(self, source, function, parameter):
+        '''Lines explaining where the values of a function parameter come from.'''
+        key = (id(function), parameter)
+        if key not in self.summaries:
+            self.summaries[key] = ()  # a recursive call path ends here
+            lines = []
+            for caller, call, enclosing in self.callers(source, function):
+                argument = argument_for(call, function, parameter)
+                if argument is not None:
+                    lines += self.trace_argument(caller, call, enclosing, argument, function, parameter)
+            self.summaries[key] = tuple(lines)
+        return self.summaries[key]
+
+    def trace_argument(self, caller, call, enclosing, argument, function, parameter):
+        finder = caller.finder
+        lines = [f"'{parameter}' of function '{function.name}' is passed "
+                 f"{finder.source_segment(argument)} in {caller.path} line {call.lineno}"]
+        start = len(finder.relevant_interactions)
+        seen = set()
+        try:
+            for node in ast.walk(argument):
+                if isinstance(node, ast.Name):
+                    finder.trace_variable_origin(node.id, seen)
+        except SyntaxError:
+            pass
+        lines += finder.relevant_interactions[start:]
+        del finder.relevant_interactions[start:], finder.interaction_nodes[start:]
+
+        values = [argument] + [finder.assigned_nodes[name] for name in sorted(seen) if name in finder.assigned_nodes]
+        for value in values:
+            lines += [f'Input source: {finder.source_segment(node)}' for node in input_sources(value)]
+        for name in sorted(seen):
+            if name not in finder.function_parameters:
+                continue
+            # a parameter of the function around the call, else the one Finder knows by that name
+            outer = enclosing if enclosing and name in [arg.arg for arg in enclosing.args.args] \
+                else finder.parameter_functions[name]
+            lines += self.summary(caller, outer, name)
+        return lines
+
+    def resolve(self, entry):
+        '''Extra trace lines for one file of the repo, empty when it has no parameter origins.'''
+        source = self.by_entry.get(entry)
+        if source is None:
+            return []
+        lines = []
+        for function, parameter in source.prompt_parameters:
+            lines += self.summary(source, function, parameter)
+        return list(dict.fromkeys(lines))
+
+class Resolver:
+    '''
+    Adds interprocedural trace lines to parse results whose prompt comes in as a
+    function parameter. Repositories are indexed the first time one of their
+    files needs it, and the most recent max_repos indexes are kept. sandbox is
+    the SandboxPool configuration files are parsed under (timeout, max_rss_mb),
+    None parses them in this process.
+    '''
+    def __init__(self, entries, max_repos=16, sandbox=None, quarantine=None, workers=1):
+        self.entries = {}
+        self.repos = defaultdict(list)
+        for entry in entries:
+            if entry[0].endswith('.py'):
+                self.entries[repo_url(entry)] = entry
+                self.repos[entry[1]].append(entry)
+        self.max_repos = max_repos
+        self.indexes = OrderedDict()
+        self.resolved = 0
+        self.sandbox = sandbox
+        self.workers = workers
+        self.pool = None  # started by the first repository that is indexed
+        self.quarantine = quarantine
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+
+    def index(self, repo_name):
+        if repo_name in self.indexes:
+            self.indexes.move_to_end(repo_name)
+        else:
+            if self.sandbox is not None and self.pool is None:
+                self.pool = SandboxPool(self.workers, **self.sandbox)
+            self.indexes[repo_name] = RepoIndex(self.repos[repo_name], self.pool, self.quarantine)
+            if len(self.indexes) > self.max_repos:
+                self.indexes.popitem(last=False)
+        return self.indexes[repo_name]
+
+    def resolve(self, result):
+        create_calls = result.get('create_calls') or []
+        entry = self.entries.get(result['url'])
+        if entry is None or not (result.get('calls') or create_calls):
+            return result
+        # whether the prompt comes from a parameter is up to SourceFile.prompt_parameters, Finder
+        # only says so when the prompt argument itself is one
+        lines = [line for line in self.index(entry[1]).resolve(entry) if line not in create_calls]
+        if not lines:
+            return result
+        self.resolved += 1
+        return {**result, "create_calls": create_calls + lines}
+
+def main():
+    parser = argparse.ArgumentParser(description='Follow prompts that arrive as function parameters through their '
+                                                 'call sites in the other files of each repository.')
+    parser.add_argument('path', nargs='?', default='parse.json', help='parse.py results, .json or .jsonl')
+    parser.add_argument('--repos', default='repos/repos.txt')
+    parser.add_argument('--output', help='where to write the extended results, defaults to overwriting path')
+    parser.add_argument('--workers', type=int, default=1, help='processes parsing the files of a repository')
+    add_sandbox_arguments(parser)
+    args = parser.parse_args(sys.argv[1:])
+
+    sandbox = sandbox_options(args, args.workers)
+    quarantine = open_quarantine(args)
+    resolver = Resolver(read_repos_file(args.repos), sandbox=sandbox, quarantine=quarantine, workers=args.workers)
+    results = (resolver.resolve(result) for result in load_parse_results(args.path))
+    output = args.output or args.path
+    count = 0
+    try:
+        if output.endswith('.jsonl'):
+            with open(output + '.tmp', 'w') as f:
+                for result in results:
+                    f.write(json.dumps(result) + '\n')
+                    count += 1
+            os.replace(output + '.tmp', output)
+        else:
+            results = list(results)
+            count = len(results)
+            save_results_to_json(results, output)
+    finally:
+        resolver.close()
+        quarantine.close()
+    print(f'{resolver.resolved} of {count} results extended through their call sites')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import json
+import os
+
+class JsonlWriter:
+    '''
+    Appends one json record per line and fsyncs every fsync_every records, so an
+    interrupted run keeps everything up to the last synced record. Opening an
+    existing file drops a torn last line and sets count to the number of
+    complete records, which callers use to skip work already done. With a key,
+    a record whose value for that field the file already has is not written
+    again, so a rerun over the same inputs does not repeat them.
+    '''
+    def __init__(self, path, fsync_every=1000, key=None):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.count = count_complete_records(path)
+        self.key = key
+        self.keys = {record.get(key) for record in read_jsonl(path)} if key and self.count else set()
+        self.file = open(path, 'a')
+        self._unsynced = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, value):
+        return value in self.keys
+
+    def write(self, record):
+        # False for a record the file already has under its key
+        if self.key:
+            if record[self.key] in self.keys:
+                return False
+            self.keys.add(record[self.key])
+        self.file.write(json.dumps(record) + '\n')
+        self.count += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+        return True
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+def count_complete_records(path):
+    try:
+        f = open(path, 'rb+')
+    except FileNotFoundError:
+        return 0
+    with f:
+        count = 0
+        end = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            count += 1
+            end += len(line)
+        f.truncate(end)
+    return count
+
+def read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if line.endswith('\n'):
+                yield json.loads(line)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+class Manifest:
+    '''
+    Persistent record of past Finder runs, keyed by (content sha256, Finder
+    version), so that unchanged files are not parsed again. A (path, size,
+    mtime) index avoids rehashing files that have not been touched.
+    '''
+    def __init__(self, path='manifest.sqlite'):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS finder_results (
+                sha256 TEXT NOT NULL,
+                finder_version INTEGER NOT NULL,
+                result TEXT,
+                PRIMARY KEY (sha256, finder_version)
+            );
+        ''')
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def file_hash(self, path):
+        '''sha256 of a file on disk, or None if it does not exist.'''
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        row = self.db.execute(
+            'SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?',
+            (path, st.st_size, st.st_mtime_ns)
+        ).fetchone()
+        if row:
+            return row[0]
+        with open(path, 'rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        self.db.execute(
+            'INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)',
+            (path, st.st_size, st.st_mtime_ns, sha256)
+        )
+        return sha256
+
+    def get(self, sha256, finder_version):
+        '''
+        Returns (found, result), where result holds the stored create_calls and
+        calls, or is None when the file failed to parse last time.
+        '''
+        row = self.db.execute(
+            'SELECT result FROM finder_results WHERE sha256 = ? AND finder_version = ?',
+            (sha256, finder_version)
+        ).fetchone()
+        if row is None:
+            return False, None
+        return True, None if row[0] is None else json.loads(row[0])
+
+    def put(self, sha256, finder_version, result):
+        self.db.execute(
+            'INSERT OR REPLACE INTO finder_results (sha256, finder_version, result) VALUES (?, ?, ?)',
+            (sha256, finder_version, None if result is None else json.dumps(result))
+        )
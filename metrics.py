@@ -0,0 +1,193 @@
+import bisect
+import cProfile
+import http.server
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import pyinstrument
+except ImportError:  # optional, --profile falls back to cProfile
+    pyinstrument = None
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in list(self.values.items()):
+            lines.append(f'{self.name}{format_labels(key)} {value}')
+        return lines
+
+    def snapshot(self):
+        return [{'labels': dict(key), 'value': value} for key, value in list(self.values.items())]
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # labels -> [per-bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts, _, _ = entry = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(list(self.buckets) + ['+Inf'], counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{format_labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return lines
+
+    def snapshot(self):
+        return [{'labels': dict(key), 'count': count, 'sum': round(total, 6),
+                 'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], counts))}
+                for key, (counts, total, count) in list(self.values.items())]
+
+class Registry:
+    '''
+    Counters and histograms with labels, rendered in the Prometheus text format
+    or as a json snapshot. Only the process that updates a metric sees it, so
+    work done in pool workers is measured by the parent from what they return.
+    '''
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help):
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def render(self):
+        return '\n'.join(line for metric in list(self.metrics.values()) for line in metric.render()) + '\n'
+
+    def snapshot(self):
+        return {'time': time.time(), 'metrics': {name: metric.snapshot() for name, metric in list(self.metrics.items())}}
+
+    def dump(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(path + '.tmp', path)
+
+METRICS = Registry()
+
+HTTP_REQUESTS = METRICS.counter('http_requests_total', 'HTTP responses received, by host and status.')
+HTTP_BYTES = METRICS.counter('http_response_bytes_total', 'Response body bytes received, by host.')
+HTTP_RETRIES = METRICS.counter('http_retries_total', 'Requests retried after an error or a retryable status, by host.')
+HTTP_CACHE_HITS = METRICS.counter('http_cache_hits_total', 'Responses served from the blob cache, by host.')
+HTTP_SECONDS = METRICS.histogram('http_request_seconds', 'Time for one HTTP request, by host.')
+
+PARSE_FILES = METRICS.counter('parse_files_total', 'Files handled by the parse stage, by outcome.')
+PARSE_SECONDS = METRICS.histogram('parse_seconds', 'ast.parse plus Finder time for one file.')
+
+LLM_REQUESTS = METRICS.counter('llm_requests_total', 'Chat completion requests, by model and outcome.')
+LLM_TOKENS = METRICS.counter('llm_tokens_total', 'Tokens reported by the API, by model and direction.')
+LLM_CACHE_HITS = METRICS.counter('llm_cache_hits_total', 'Completions served from the response cache, by model.')
+LLM_SECONDS = METRICS.histogram('llm_request_seconds', 'Time for one chat completion request, by model.')
+
+STAGE_ITEMS = METRICS.counter('stage_items_total', 'Items taken by a pipeline stage.')
+STAGE_ERRORS = METRICS.counter('stage_errors_total', 'Items a pipeline stage failed on.')
+STAGE_SECONDS = METRICS.histogram('stage_item_seconds', 'Time a pipeline stage spent on one item, excluding backpressure.')
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def add_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, help='serve prometheus metrics on this port while running')
+    parser.add_argument('--metrics-json', metavar='PATH', help='dump metrics as json to PATH periodically and at exit')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='seconds between json dumps')
+
+def start(args):
+    '''Starts what the --metrics-* options ask for and returns a function that stops it.'''
+    server = None
+    stop = threading.Event()
+    if args.metrics_port:
+        server = http.server.ThreadingHTTPServer(('', args.metrics_port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if args.metrics_json:
+        def dump_periodically():
+            while not stop.wait(args.metrics_interval):
+                METRICS.dump(args.metrics_json)
+        threading.Thread(target=dump_periodically, daemon=True).start()
+
+    def close():
+        stop.set()
+        if args.metrics_json:
+            METRICS.dump(args.metrics_json)
+        if server:
+            server.shutdown()
+    return close
+
+@contextmanager
+def profile(path):
+    '''
+    Profiles the enclosed block into path: pyinstrument html when path ends in
+    .html and pyinstrument is installed, cProfile stats otherwise.
+    '''
+    if path.endswith('.html') and pyinstrument:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
@@ -0,0 +1,143 @@
+import asyncio
+import re
+from collections import deque
+
+from ask_openai import ANSWER, INSTRUCTIONS, SYSTEM_PROMPT, classification_messages, split_answers
+from classifier import count_tokens
+
+SNIPPET = re.compile(r'^[#*\s]*snippet\s*#?\s*(\d+)\b.*$', re.I | re.M)
+
+def create_packed_prompt(snippets):
+    # one copy of the instructions and examples for several (id, code) snippets
+    code = ''.join(f'\n### Snippet {id}\n{text}\n' for id, text in snippets)
+    ids = ', '.join(id for id, _ in snippets)
+    return (f'The following are {len(snippets)} pieces of code, each starting with a line "### Snippet <ID>": {code}\n'
+            + INSTRUCTIONS +
+            f'\nAnswer the questions separately for every snippet ({ids}). Start the answers to each snippet with '
+            f'the line "### Snippet <ID>", followed by its five numbered answers.\n')
+
+def packed_messages(snippets):
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': create_packed_prompt(snippets)}
+    ]
+
+def split_packed(text, ids):
+    '''
+    {id: answers text} for the snippets of ids a packed response answers in
+    full, i.e. with all five numbered answers under its header, each once. A
+    section with two sets of answers has lost the header between them, and
+    is left out rather than given answers that may belong to another snippet.
+    '''
+    headers = [match for match in SNIPPET.finditer(text) if match.group(1) in ids]
+    sections = {}
+    for match, after in zip(headers, headers[1:] + [None]):
+        section = text[match.end():after.start() if after else len(text)]
+        numbers = sorted(number for number, _ in ANSWER.findall(section))
+        if match.group(1) not in sections and numbers == list('12345') and all(split_answers(section)):
+            sections[match.group(1)] = section.strip()
+    return sections
+
+def pack(sources, budget=4000, model='gpt-3.5-turbo', max_files=8):
+    '''
+    Groups an iterable of (key, code) into lists of consecutive sources whose
+    code adds up to at most budget tokens and max_files files. A file over the
+    budget on its own is sent alone.
+    '''
+    batch, used = [], 0
+    for key, code in sources:
+        tokens = count_tokens(code, model)
+        if batch and (used + tokens > budget or len(batch) >= max_files):
+            yield batch
+            batch, used = [], 0
+        batch.append((key, code))
+        used += tokens
+    if batch:
+        yield batch
+
+class PackedSampler:
+    '''
+    Samples classifications for batches of files, several files per request so
+    that the instructions and examples are paid for once per request instead of
+    once per file. Each response is split back into per-file answers by
+    snippet ID. Files a response leaves out or answers only in part are sent
+    again in a smaller pack, and then on their own, so every file is answered.
+    As in Classifier.sample_until, with settled a file stops getting samples
+    once its answers agree, and the files of a batch that need more are packed
+    again without it.
+    '''
+    def __init__(self, classifier, samples, settled=None, min_samples=1):
+        self.classifier = classifier
+        self.samples = samples
+        self.settled = settled
+        self.min_samples = min(min_samples, samples) if settled else samples
+        self.requests = 0
+        self.repacked = 0
+        self.alone = 0
+
+    async def ask(self, batch, sample):
+        # {key: response} for one sample of every (key, code) in batch
+        answered = {}
+        missing = batch
+        for attempt in range(2):  # the pack, then the files it left out
+            if len(missing) < 2:
+                break
+            self.repacked += attempt
+            ids = {str(i + 1): (key, code) for i, (key, code) in enumerate(missing)}
+            self.requests += 1
+            text = await self.classifier.complete(packed_messages([(id, code) for id, (_, code) in ids.items()]),
+                                                  sample, self.classifier.max_tokens * len(ids))
+            for id, section in split_packed(text, ids).items():
+                answered[ids[id][0]] = section
+            missing = [(key, code) for key, code in missing if key not in answered]
+        if len(batch) > 1:
+            self.alone += len(missing)
+        for key, code in missing:  # the same request as without packing, so it shares the cache
+            self.requests += 1
+            answered[key] = await self.classifier.complete(classification_messages(code), sample)
+        return answered
+
+    def wanted(self, responses):
+        if len(responses) >= self.samples:
+            return False
+        return len(responses) < self.min_samples or not self.settled(responses)
+
+    async def sample(self, batch):
+        '''{key: [responses]} for a batch from pack().'''
+        responses = {key: [] for key, _ in batch}
+        rounds = await asyncio.gather(*(self.ask(batch, i) for i in range(self.min_samples)))
+        for answered in rounds:
+            for key, text in answered.items():
+                responses[key].append(text)
+        while True:
+            batch = [(key, code) for key, code in batch if self.wanted(responses[key])]
+            if not batch:
+                return responses
+            for key, text in (await self.ask(batch, len(responses[batch[0][0]]))).items():
+                responses[key].append(text)
+
+    async def sample_many(self, batches, window=None):
+        '''
+        Like Classifier.sample_many, over batches from pack(): yields (key,
+        responses or exception) per file, in input order.
+        '''
+        async def run(batch):
+            try:
+                return await self.sample(batch)
+            except Exception as e:
+                return {key: e for key, _ in batch}
+
+        window = window or self.classifier.concurrency * 2
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, asyncio.ensure_future(run(batch))))
+            if len(pending) >= window:
+                batch, task = pending.popleft()
+                results = await task
+                for key, _ in batch:
+                    yield key, results[key]
+        while pending:
+            batch, task = pending.popleft()
+            results = await task
+            for key, _ in batch:
+                yield key, results[key]
@@ -1,26 +1,95 @@
+import argparse
+import asyncio
 import ast  # Documentation: https://docs.python.org/3/library/ast.html
+import hashlib
 import json
 import os
+import re
 import sys
-from urllib.request import urlopen
+import time
+from collections.abc import Mapping
+from contextlib import nullcontext
+from functools import partial
+from itertools import islice
+
+from cache import BlobCache
+from dedup import LSHIndex
+from fetch import Fetcher, add_arguments as add_fetch_arguments
+from ingest import LINE_END, SOURCE_SUFFIXES, cell_position, decode_source, map_file, read_notebook, source_text
+from jsonl import JsonlWriter
+from manifest import Manifest
+from metrics import PARSE_FILES, PARSE_SECONDS, add_arguments as add_metrics_arguments, profile, start as start_metrics
+from patterns import DISPATCH, match_call
+from prefilter import PREFILTER
+from sandbox import SandboxPool, add_arguments as add_sandbox_arguments, open_quarantine, options as sandbox_options
+from store import ResultStore
+
+SOURCE_LINE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+\Z')
+
+class Segments(Mapping):
+    '''
+    Variable -> source of the value last assigned to it. Only the value nodes
+    are kept, and a segment is cut out of the source the first time it is read,
+    which for most assignments is never.
+    '''
+    def __init__(self, finder):
+        self.finder = finder
+        self.segments = {}
+
+    def __getitem__(self, variable):
+        node = self.finder.assigned_nodes[variable]
+        if node not in self.segments:
+            self.segments[node] = self.finder.source_segment(node)
+        return self.segments[node]
+
+    def __contains__(self, variable):
+        return variable in self.finder.assigned_nodes
+
+    def __iter__(self):
+        return iter(self.finder.assigned_nodes)
+
+    def __len__(self):
+        return len(self.finder.assigned_nodes)
 
 class Finder(ast.NodeVisitor):
-    def __init__(self, source_code: str):
+    VERSION = 3  # bump whenever a change alters relevant_interactions, it invalidates the manifest
+
+    def __init__(self, source_code, dispatch=DISPATCH):
+        # source_code is a str, or utf-8 bytes or an mmap from ingest.decode_source
+        self.dispatch = dispatch
+        self.calls = []
+        self.call_nodes = []
         self.target_variable = None
-        self.all_assignments = {}
+        self.all_assignments = Segments(self)
         self.relevant_interactions = [] 
         self.function_parameters = {}
         self.source_code = source_code
+        # def-use index over the original AST: the value node behind each entry of
+        # all_assignments, the names each value reads (collected once per node), and a
+        # generation counter per name so memoized traces know when a binding changed
+        self.assigned_nodes = {}
+        self.generations = {}
+        # the statement behind each entry of relevant_interactions (the Assign, or the
+        # FunctionDef of a parameter), used by slicer.py to cut the code down
+        self.interaction_nodes = []
+        self.assigned_statements = {}
+        self.parameter_functions = {}
+        self._utf8 = None
+        self._line_starts = None
+        self._reads = {}
+        self._traces = {}
+        self._consulted = None
+        self._clean = True
 
     def visit_Call(self, node: ast.Call):
-        if isinstance(node.func, ast.Attribute):
-            if (node.func.attr == 'create' and
-                    isinstance(node.func.value, ast.Attribute) and
-                    node.func.value.attr == 'ChatCompletion' and
-                    isinstance(node.func.value.value, ast.Name)):
-                # print("Found 'ChatCompletion.create' call at line:", node.lineno)
-                self.print_arguments(node)
-                self.filter_interactions()
+        # every registered pattern is matched here, see patterns.py
+        pattern = match_call(node.func, self.dispatch)
+        if pattern:
+            # print(f"Found '{pattern.name}' call at line:", node.lineno)
+            self.calls.append({"pattern": pattern.name, "line": node.lineno})
+            self.call_nodes.append(node)
+            self.print_arguments(node, pattern.prompt_arg)
+            self.filter_interactions()
         self.generic_visit(node)
 
     def visit_Assign(self, node: ast.Assign):
@@ -28,57 +97,128 @@ class Finder(ast.NodeVisitor):
         for target in node.targets:
             if isinstance(target, ast.Name):
                 # print(target.id)
-                assignment_str = ast.get_source_segment(self.source_code, node.value)
-                self.all_assignments[target.id] = assignment_str
+                self.assigned_nodes[target.id] = node.value
+                self.assigned_statements[target.id] = node
+                self.rebind(target.id)
         self.generic_visit(node)
 
     def visit_FunctionDef(self, node: ast.FunctionDef):
         for arg in node.args.args:
             self.function_parameters[arg.arg] = node.name
+            self.parameter_functions[arg.arg] = node
+            self.rebind(arg.arg)
         self.generic_visit(node)
 
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def rebind(self, variable):
+        self.generations[variable] = self.generations.get(variable, 0) + 1
+
+    def source_segment(self, node):
+        # same result as ast.get_source_segment, which splits the whole source on every
+        # call; ast column offsets count utf-8 bytes, so only line start offsets are kept
+        # and just the segment is sliced out of the utf-8 source and decoded
+        if self._line_starts is None:
+            source = self.source_code
+            self._utf8 = source.encode() if isinstance(source, str) else source
+            self._line_starts = [0] + [match.end() for match in LINE_END.finditer(self._utf8)]
+        start = self._line_starts[node.lineno - 1] + node.col_offset
+        end = self._line_starts[node.end_lineno - 1] + node.end_col_offset
+        return str(self._utf8[start:end], 'utf-8')
+
+    def consult(self, variable):
+        if self._consulted is not None:
+            self._consulted[variable] = self.generations.get(variable, 0)
+
+    def names_read(self, variable):
+        '''
+        Names read by the current value of an assigned variable, in ast.walk order:
+        FormattedValue names for values whose source starts with "f", every Name
+        otherwise. Returns (names, SyntaxError or None).
+        '''
+        value = self.assigned_nodes[variable]
+        if value not in self._reads:
+            segment = self.all_assignments[variable]
+            # single-line segments reparse to an identical tree, so the original nodes
+            # are walked directly; multi-line ones (e.g. implicit string concatenation)
+            # and walrus values may not parse standalone and are checked once
+            tree = value
+            if value.lineno != value.end_lineno or isinstance(value, ast.NamedExpr):
+                try:
+                    tree = ast.parse(segment)
+                except SyntaxError as e:
+                    tree = e
+            if isinstance(tree, SyntaxError):
+                self._reads[value] = ([], tree)
+            elif segment.startswith("f"):
+                self._reads[value] = ([node.value.id for node in ast.walk(tree)
+                                       if isinstance(node, ast.FormattedValue) and isinstance(node.value, ast.Name)], None)
+            else:
+                self._reads[value] = ([node.id for node in ast.walk(tree) if isinstance(node, ast.Name)], None)
+        return self._reads[value]
+
     def trace_variable_origin(self, variable, seen_vars: set):
         # print(f'tracing for {variable}')
         if variable in seen_vars:
             return
 
+        self.consult(variable)
         if variable in self.function_parameters:
             func_name = self.function_parameters[variable]
             self.relevant_interactions.append(f"'{variable}' originates as a parameter in function '{func_name}'")
+            self.interaction_nodes.append(self.parameter_functions[variable])
             seen_vars.add(variable)
             return
 
         if variable in self.all_assignments:
             assigned_value = self.all_assignments[variable]
             self.relevant_interactions.append(f"Variable '{variable}' is assigned to: {assigned_value}")
+            self.interaction_nodes.append(self.assigned_statements[variable])
             seen_vars.add(variable)
 
+            names, error = self.names_read(variable)
             if assigned_value.startswith("f"):
-                self.handle_f_string(assigned_value, seen_vars)
+                self.handle_f_string(assigned_value, names, error, seen_vars)
             else:
-                for node in ast.walk(ast.parse(assigned_value)):
-                    if isinstance(node, ast.Name) and node.id in self.all_assignments and node.id not in seen_vars:
-                        self.trace_variable_origin(node.id, seen_vars)
+                if error:
+                    raise type(error)(*error.args)
+                for name in names:
+                    self.consult(name)
+                    if name in self.all_assignments and name not in seen_vars:
+                        self.trace_variable_origin(name, seen_vars)
 
-    def handle_f_string(self, f_string, seen_vars):
+    def handle_f_string(self, f_string, names, error, seen_vars):
         try:
-            parsed = ast.parse(f_string)
-            for node in ast.walk(parsed):
-                if isinstance(node, ast.FormattedValue):
-                    if isinstance(node.value, ast.Name) and node.value.id not in seen_vars:
-                        self.trace_variable_origin(node.value.id, seen_vars)
+            if error:
+                raise type(error)(*error.args)
+            for name in names:
+                if name not in seen_vars:
+                    self.trace_variable_origin(name, seen_vars)
         except SyntaxError:
+            self._clean = False
             print(f"syntax error while parsing f-string: {f_string}")
 
     def filter_interactions(self):
         if self.target_variable:
             # print('TARGET VARIABlEfJLSFJDL', self.target_variable)
+            # a trace is replayed while none of the names it looked up have been rebound
+            cached = self._traces.get(self.target_variable)
+            if cached and all(self.generations.get(name, 0) == gen for name, gen in cached[1].items()):
+                self.relevant_interactions.extend(cached[0])
+                self.interaction_nodes.extend(cached[2])
+                return
+            start = len(self.relevant_interactions)
+            self._consulted, self._clean = {}, True
             self.trace_variable_origin(self.target_variable, set())
+            if self._clean:
+                self._traces[self.target_variable] = (
+                    self.relevant_interactions[start:], self._consulted, self.interaction_nodes[start:])
+            self._consulted = None
 
-    def print_arguments(self, node: ast.Call):
+    def print_arguments(self, node: ast.Call, prompt_arg='messages'):
         # print("Arguments:")
         for kw in node.keywords:
-            if kw.arg == 'messages':
+            if kw.arg == prompt_arg:
                 if isinstance(kw.value, ast.Name): 
                     self.target_variable = kw.value.id
                     # print("  - Keyword Arg: messages =", ast.dump(kw.value))
@@ -100,10 +240,22 @@ class Finder(ast.NodeVisitor):
                 print(f"  - Keyword Arg: {kw.arg} = {ast.dump(kw.value)}")
             
 def find_openai_chatcompletions_calls(code):
+    return find_llm_calls(code)[0]
+
+def find_llm_calls(code):
+    # returns (relevant_interactions, calls), where calls tags each matched call with its pattern;
+    # code is a str or what ingest.decode_source returns
     tree = ast.parse(code)
     finder = Finder(code)
     finder.visit(tree)
-    return finder.relevant_interactions
+    return finder.relevant_interactions, finder.calls
+
+def find_notebook_calls(code, cells):
+    # find_llm_calls over read_notebook's module, with the cell of each call and its line there
+    interactions, calls = find_llm_calls(code)
+    for call in calls:
+        call["cell"], call["cell_line"] = cell_position(cells, call["line"])
+    return interactions, calls
 
 def parse_py_files_from_json(json_file):
     with open(json_file, 'r') as file:
@@ -115,46 +267,340 @@ def save_results_to_json(results, file_path):
     with open(file_path, 'w') as file:
         json.dump(results, file, indent=4)
 
+def read_repos_file(path='repos/repos.txt'):
+    with open(path) as repos:
+        for line in repos:
+            # each line is the repr of a (fn, repo_name, repo_path) tuple, see analyse_code.py
+            if line.strip():
+                yield ast.literal_eval(line)
+
+def repo_url(entry):
+    fn, repo_name, repo_path = entry
+    return f'https://raw.githubusercontent.com/{repo_name}/main/{repo_path}'
+
+def repo_result(entry, interactions, calls):
+    return {
+        "url": repo_url(entry),
+        "create_calls": interactions,
+        "calls": calls
+    }
+
+def analyse_repo_file(entry, prefilter=PREFILTER):
+    # returns (result, error) so that worker processes never raise back into the pool;
+    # (None, None) means the prefilter ruled the file out without parsing it
+    fn, repo_name, repo_path = entry
+    if fn.endswith('.ipynb'):
+        return analyse_notebook_file(entry, prefilter)
+    try:
+        with map_file(f'repos/{fn}') as data:
+            if prefilter and not prefilter.match(data):
+                return None, None
+            try:
+                interactions, calls = find_llm_calls(decode_source(data))
+            except Exception:
+                return None, f'error in {repo_name}, {fn}'
+    except FileNotFoundError:
+        return None, f'cannot find file {fn}'
+    return repo_result(entry, interactions, calls), None
+
+def analyse_notebook_file(entry, prefilter=PREFILTER):
+    fn, repo_name, repo_path = entry
+    try:
+        with open(f'repos/{fn}', 'rb') as f:
+            code, cells = read_notebook(f)
+    except FileNotFoundError:
+        return None, f'cannot find file {fn}'
+    except Exception:
+        return None, f'cannot read notebook {fn}'
+    if prefilter and not prefilter.match(code.encode()):
+        return None, None
+    try:
+        interactions, calls = find_notebook_calls(code, cells)
+    except Exception:
+        return None, f'error in {repo_name}, {fn}'
+    return repo_result(entry, interactions, calls), None
+
+def timed_analyse_repo_file(entry, prefilter=PREFILTER):
+    # runs in the pool workers, whose metrics the parent never sees, so the time goes back with the result
+    start = time.monotonic()
+    result, error = analyse_repo_file(entry, prefilter)
+    return result, error, time.monotonic() - start
+
+def record_outcome(result, error, seconds=None, source='parsed'):
+    if error:
+        PARSE_FILES.inc(outcome='failed')
+    elif not result:
+        PARSE_FILES.inc(outcome='skipped')
+    else:
+        PARSE_FILES.inc(outcome=source)
+    if seconds is not None and (result or error):
+        PARSE_SECONDS.observe(seconds)
+
+def sketch_repo_file(entry, hasher, prefilter=PREFILTER):
+    # None for files the prefilter rules out or that cannot be read, they are never clustered
+    try:
+        if entry[0].endswith('.ipynb'):
+            with open(f'repos/{entry[0]}', 'rb') as f:
+                code = read_notebook(f)[0]
+            return hasher.sketch(code) if not prefilter or prefilter.match(code.encode()) else None
+        with map_file(f'repos/{entry[0]}') as data:
+            if prefilter and not prefilter.match(data):
+                return None
+            return hasher.sketch(source_text(decode_source(data)))
+    except Exception:
+        return None
+
+def duplicate_result(url, rep, dedup):
+    # a near-duplicate gets the result of its cluster's representative
+    result, error = dedup.results[rep]
+    if error:
+        return None, f'{error} (duplicate of {rep})'
+    if result is None:
+        return None, None
+    return {**result, "url": url, "duplicate_of": rep}, None
+
+def run_tasks(pool, func, items):
+    # (failure, result) per item in input order; failure is the reason a sandboxed task did not finish
+    if pool:
+        return pool.map(func, items)
+    return ((None, func(item)) for item in items)
+
+def scan_chunk(chunk, pool=None, chunk_size=256, manifest=None, prefilter=PREFILTER, dedup=None, quarantine=None):
+    # files whose (sha256, Finder.VERSION) is already in the manifest reuse the
+    # stored create_calls and calls; only the rest are parsed
+    hashes = [manifest.file_hash(f'repos/{entry[0]}') if manifest else None for entry in chunk]
+    stored = [manifest.get(sha256, Finder.VERSION) if sha256 else (False, None) for sha256 in hashes]
+    todo = [entry for entry, (found, _) in zip(chunk, stored) if not found]
+    held = {entry[0] for entry in todo if quarantine and f'repos/{entry[0]}' in quarantine}
+    todo = [entry for entry in todo if entry[0] not in held]
+    duplicates = {}
+    if dedup:
+        sketch = partial(sketch_repo_file, hasher=dedup.hasher, prefilter=prefilter)
+        for entry, (_, file_sketch) in zip(todo, run_tasks(pool, sketch, todo)):
+            url = repo_url(entry)
+            if file_sketch and dedup.add(url, sketch=file_sketch) != url:
+                duplicates[url] = dedup.representative[url]
+        todo = [entry for entry in todo if repo_url(entry) not in duplicates]
+    fresh = run_tasks(pool, partial(timed_analyse_repo_file, prefilter=prefilter), todo)
+
+    for entry, sha256, (found, analysis) in zip(chunk, hashes, stored):
+        url = repo_url(entry)
+        if entry[0] in held:
+            PARSE_FILES.inc(outcome='quarantined')
+            yield url, None, f'quarantined {entry[0]}: {quarantine.reason(f"repos/{entry[0]}")}'
+        elif url in duplicates:
+            result, error = duplicate_result(url, duplicates[url], dedup)
+            record_outcome(result, error, source='duplicate')
+            yield url, result, error
+        elif not found:
+            failure, outcome = next(fresh)
+            if failure:
+                # the file hung, blew the memory cap or crashed its worker: keep it out of later runs
+                PARSE_FILES.inc(outcome='quarantined')
+                if quarantine:
+                    quarantine.add(f'repos/{entry[0]}', failure, url=url)
+                error = f'quarantined {entry[0]}: {failure}'
+                if dedup and url in dedup.signatures:
+                    dedup.results[url] = (None, error)  # its duplicates fail with it instead of waiting on a result
+                yield url, None, error
+                continue
+            result, error, seconds = outcome
+            record_outcome(result, error, seconds)
+            if sha256 and (result or error):
+                manifest.put(sha256, Finder.VERSION, result and {"create_calls": result["create_calls"], "calls": result["calls"]})
+            if dedup and url in dedup.signatures:
+                dedup.results[url] = (result, error)
+            yield url, result, error
+        elif analysis is None:
+            PARSE_FILES.inc(outcome='failed')
+            yield url, None, f'error in {entry[1]}, {entry[0]}'
+        else:
+            PARSE_FILES.inc(outcome='manifest')
+            yield url, repo_result(entry, analysis["create_calls"], analysis["calls"]), None
+
+def scan_repo_files(entries, workers=1, chunk_size=256, manifest=None, skip=0, prefilter=PREFILTER, dedup=None,
+                    sandbox=None, quarantine=None):
+    # files are parsed in SandboxPool workers, configured by the sandbox dict (timeout,
+    # max_rss_mb); only a single worker with sandbox=None parses in this process.
+    # Results are merged in input order, so the output matches the serial scan exactly.
+    # skip drops files that a resumed run already wrote out. With a dedup LSHIndex only
+    # the first file of each near-duplicate cluster is parsed. Notebooks are reduced to
+    # their code cells, and their calls carry the cell they are in
+    entries = islice((entry for entry in entries if entry[0].endswith(SOURCE_SUFFIXES)), skip, None)
+    pool = SandboxPool(workers, **(sandbox or {})) if sandbox is not None or workers > 1 else None
+    try:
+        while True:
+            chunk = list(islice(entries, chunk_size * workers))
+            if not chunk:
+                break
+            yield from scan_chunk(chunk, pool, chunk_size, manifest, prefilter, dedup, quarantine)
+            if manifest:
+                manifest.commit()
+    finally:
+        if pool:
+            pool.shutdown()
+
+def analyse_download(url, body, manifest=None):
+    sha256 = hashlib.sha256(body).hexdigest() if manifest else None
+    found, analysis = manifest.get(sha256, Finder.VERSION) if manifest else (False, None)
+    if found and analysis is not None:
+        return {"url": url, **analysis}, None
+    try:
+        interactions, calls = find_llm_calls(decode_source(body))
+        if manifest:
+            manifest.put(sha256, Finder.VERSION, {"create_calls": interactions, "calls": calls})
+        return {
+            "url": url,
+            "create_calls": interactions,
+            "calls": calls
+        }, None
+    except Exception as e:
+        return None, f"Error parsing {url}: {e}"
+
+async def download_and_parse(urls, concurrency=32, cache=None, revalidate=True, manifest=None, prefilter=PREFILTER, dedup=None,
+                             per_host_rate=None):
+    async with Fetcher(concurrency=concurrency, per_host_rate=per_host_rate, cache=cache, revalidate=revalidate) as fetcher:
+        async for url, res in fetcher.fetch_many(urls):
+            if res is None:
+                yield url, None, f"Error downloading {url}"
+                continue
+            if prefilter and not prefilter.match(res.body):
+                PARSE_FILES.inc(outcome='skipped')
+                yield url, None, None
+                continue
+            if dedup and dedup.add(url, source_text(decode_source(res.body))) != url:
+                result, error = duplicate_result(url, dedup.representative[url], dedup)
+                record_outcome(result, error, source='duplicate')
+                yield url, result, error
+                continue
+            start = time.monotonic()
+            result, error = analyse_download(url, res.body, manifest)
+            record_outcome(result, error, time.monotonic() - start)
+            if dedup:
+                dedup.results[url] = (result, error)
+            yield url, result, error
+
+def verify_prefilter(entries):
+    # the prefilter must never skip a file that Finder matches
+    checked = missed = 0
+    for entry in entries:
+        path = f'repos/{entry[0]}'
+        if not entry[0].endswith('.py') or not os.path.exists(path) or PREFILTER.match_file(path):
+            continue
+        checked += 1
+        result, error = analyse_repo_file(entry, prefilter=None)
+        if result and result["calls"]:
+            missed += 1
+            print(f'prefilter skipped {path}, which has {len(result["calls"])} calls')
+    print(f'{checked} skipped files parsed, {missed} with calls')
+    return missed
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', help="'p' to scan repos/repos.txt, 'j' to download code_search/raw_data_all.json")
+    parser.add_argument('--workers', type=int, default=1, help='processes for the p scan (0 = all cores)')
+    parser.add_argument('--chunk-size', type=int, default=256, help='files handed to each worker per round')
+    parser.add_argument('--concurrency', type=int, default=32, help='parallel downloads for the j mode')
+    parser.add_argument('--cache-dir', default='cache', help='blob cache for the j mode downloads')
+    parser.add_argument('--no-revalidate', action='store_true', help='serve cached urls without an If-None-Match request')
+    add_fetch_arguments(parser)
+    parser.add_argument('--manifest', default='manifest.sqlite', help='past analyses, reused for unchanged files')
+    parser.add_argument('--full', action='store_true', help='ignore the manifest and reanalyse every file')
+    parser.add_argument('--no-prefilter', action='store_true', help='parse every file, even those without any call pattern token')
+    parser.add_argument('--verify-prefilter', action='store_true', help='parse the files the prefilter skips and report any with calls')
+    parser.add_argument('--jsonl', metavar='PATH', help='stream one record per file to PATH instead of writing parse.json; '
+                                                        'rerunning with the same PATH resumes after the last complete record')
+    parser.add_argument('--dedup', type=float, metavar='THRESHOLD',
+                        help='parse only the first of each group of files with at least this estimated similarity (e.g. 0.9) '
+                             'and give the others its result')
+    parser.add_argument('--parquet', metavar='DIR', help='also write calls and traces as parquet under DIR, see query.py')
+    parser.add_argument('--run', help='parquet partition to write to, defaults to the start time')
+    add_sandbox_arguments(parser)
+    parser.add_argument('--interprocedural', action='store_true',
+                        help='follow prompts that arrive as function parameters through the call sites in the rest of '
+                             'the repository, see interproc.py')
+    parser.add_argument('--profile', metavar='PATH', help='profile the run into PATH (cProfile stats, or pyinstrument html for '
+                                                          '.html); the p scan then runs in one process so Finder shows up')
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
 def main():
+    args = parse_args(sys.argv[1:])
     results = []
-    if 'p' in sys.argv[1]:
-        with open('repos/repos.txt') as repos:
-            for line in repos.readlines():
-                fn, repo_name, repo_path = line.strip()[1:-1].split(', ')
-                fn = fn[1:-1]
-                if fn.endswith('.py'):
-                    try:
-                        with open(f'repos/{fn}', 'r') as f:
-                            code = f.read()
-                        try:
-                            interactions = find_openai_chatcompletions_calls(code)
-                            results.append({
-                                "url": f'https://raw.githubusercontent.com/{repo_name[1:-1]}/main/{repo_path[1:-1]}',
-                                "create_calls": interactions
-                            })
-                        except:
-                            print(f'error in {repo_name}, {fn}')
-                            continue
-                    except FileNotFoundError:
-                        print(f'cannot find file {fn}')
-                        continue
-    elif 'j' in sys.argv[1]:
-        py_urls = parse_py_files_from_json('code_search/raw_data_all.json')
-        
-        for url in py_urls:
-            try:
-                response = urlopen(url)
-                content = response.read().decode('utf-8')
-                interactions = find_openai_chatcompletions_calls(content)
-                results.append({
-                    "url": url,
-                    "create_calls": interactions
-                })
-            except Exception as e:
-                print(f"Error downloading or parsing {url}: {e}")
-                pass
-
-    save_results_to_json(results, 'parse.json')
+    manifest = None if args.full else Manifest(args.manifest)
+    writer = JsonlWriter(args.jsonl) if args.jsonl else None
+    store = ResultStore(args.parquet, args.run) if args.parquet else None
+    skip = writer.count if writer else 0
+    prefilter = None if args.no_prefilter else PREFILTER
+    dedup = LSHIndex(args.dedup) if args.dedup else None
+    quarantine = open_quarantine(args)
+    workers = 1 if args.profile else args.workers or os.cpu_count()
+    sandbox = None if args.profile else sandbox_options(args, workers)
+    resolver = None
+    if args.interprocedural and 'p' in args.mode:
+        from interproc import Resolver  # interproc imports Finder from this module
+        resolver = Resolver(read_repos_file(), sandbox=sandbox, quarantine=quarantine, workers=workers)
+    skipped = 0
+
+    def emit(url, result, error):
+        nonlocal skipped
+        if resolver and result:
+            result = resolver.resolve(result)
+        if error:
+            print(error)
+        elif not result:
+            skipped += 1
+        if store and result:
+            store.write_result(result)
+        if writer:
+            writer.write(result or ({"url": url, "error": error} if error else {"url": url, "skipped": True}))
+        elif result:
+            results.append(result)
+
+    async def download_all(urls, cache):
+        async for record in download_and_parse(urls, args.concurrency, cache, not args.no_revalidate, manifest, prefilter, dedup,
+                                                 args.per_host_rate):
+            emit(*record)
+
+    if args.verify_prefilter:
+        verify_prefilter(read_repos_file())
+        return
+
+    stop_metrics = start_metrics(args)
+    try:
+        with profile(args.profile) if args.profile else nullcontext():
+            if 'p' in args.mode:
+                for record in scan_repo_files(read_repos_file(), workers, args.chunk_size, manifest, skip, prefilter, dedup,
+                                              sandbox, quarantine):
+                    emit(*record)
+            elif 'j' in args.mode:
+                py_urls = parse_py_files_from_json('code_search/raw_data_all.json')
+                cache = BlobCache(args.cache_dir)
+                try:
+                    asyncio.run(download_all(py_urls[skip:], cache))
+                finally:
+                    cache.close()
+    finally:
+        stop_metrics()
+        if resolver:
+            resolver.close()
+        quarantine.close()
+    if manifest:
+        manifest.close()
+    if prefilter:
+        print(f'{skipped} files skipped by the prefilter')
+    if dedup:
+        print(f'{len(dedup.representative)} files in {dedup.clusters()} near-duplicate clusters')
+    if resolver:
+        print(f'{resolver.resolved} results extended through their call sites')
+
+    if store:
+        store.close()
+        print(f'parquet results written to {args.parquet} as run {store.run}')
+    if writer:
+        writer.close()
+    else:
+        save_results_to_json(results, 'parse.json')
 
     #statistics: position/length, prompt length, number of insertions, position of insertions (exact position and percentage position), percentage of insertions within a prompt, the more flexible the insertions are the better, closer to the beginning
 
@@ -0,0 +1,52 @@
+import ast
+from collections import namedtuple
+
+# An LLM call signature. chain is the attribute path ending in the called method,
+# e.g. ('ChatCompletion', 'create'); prompt_arg is the keyword that carries the
+# prompt; name_root requires the object in front of the chain to be a plain name
+# (`openai.ChatCompletion.create`) rather than any expression (`self.client.chat...`).
+CallPattern = namedtuple('CallPattern', ['name', 'chain', 'prompt_arg', 'name_root'])
+
+PATTERNS = [
+    # openai < 1.0 module-level api
+    CallPattern('ChatCompletion.create', ('ChatCompletion', 'create'), 'messages', True),
+    CallPattern('ChatCompletion.acreate', ('ChatCompletion', 'acreate'), 'messages', True),
+    CallPattern('Completion.create', ('Completion', 'create'), 'prompt', True),
+    CallPattern('Completion.acreate', ('Completion', 'acreate'), 'prompt', True),
+    # openai >= 1.0 clients; OpenAI and AsyncOpenAI share these signatures
+    CallPattern('chat.completions.create', ('chat', 'completions', 'create'), 'messages', False),
+    CallPattern('chat.completions.with_streaming_response.create',
+                ('chat', 'completions', 'with_streaming_response', 'create'), 'messages', False),
+    CallPattern('completions.create', ('completions', 'create'), 'prompt', False),
+    CallPattern('completions.with_streaming_response.create',
+                ('completions', 'with_streaming_response', 'create'), 'prompt', False),
+]
+
+def compile_patterns(patterns):
+    '''
+    Dispatch table from the called method name to the patterns ending in it,
+    longest chain first, so that a single visit_Call can test every pattern.
+    '''
+    table = {}
+    for pattern in patterns:
+        table.setdefault(pattern.chain[-1], []).append(pattern)
+    for candidates in table.values():
+        candidates.sort(key=lambda pattern: len(pattern.chain), reverse=True)
+    return table
+
+DISPATCH = compile_patterns(PATTERNS)
+
+def match_call(func, dispatch=DISPATCH):
+    '''Returns the first pattern matching a call's func node, or None.'''
+    if not (isinstance(func, ast.Attribute) and func.attr in dispatch):
+        return None
+    for pattern in dispatch[func.attr]:
+        node = func
+        for attr in reversed(pattern.chain):
+            if not (isinstance(node, ast.Attribute) and node.attr == attr):
+                break
+            node = node.value
+        else:
+            if not pattern.name_root or isinstance(node, ast.Name):
+                return pattern
+    return None
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import cProfile
+import hashlib
+import io
+import os
+import sys
+import time
+
+from analyse_code import known_repos, read_search_output, save_download
+from analysis import is_relevant
+from ask_openai import classification_messages, consensus
+from cache import BlobCache
+from classifier import Classifier, ResponseCache
+from dedup import LSHIndex
+from fetch import Fetcher, add_arguments as add_fetch_arguments, raw_url_candidates
+from ingest import SOURCE_SUFFIXES, decode_source, read_notebook, source_text
+from jsonl import JsonlWriter
+from manifest import Manifest
+from metrics import PARSE_FILES, STAGE_ERRORS, STAGE_ITEMS, STAGE_SECONDS, add_arguments as add_metrics_arguments, start as start_metrics
+from parse import Finder, find_llm_calls, find_notebook_calls, record_outcome
+from prefilter import PREFILTER
+from sandbox import SandboxPool, add_arguments as add_sandbox_arguments, open_quarantine, options as sandbox_options
+from slicer import slice_source
+from static_classifier import classify_code
+
+DONE = object()
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class Stage:
+    '''
+    One step of the pipeline. `workers` tasks take items from the stage's input
+    queue and run `handle`, an async generator, on each; whatever it yields goes
+    to the next stage's queue. Queues are bounded, so a slow stage makes the
+    ones in front of it wait instead of piling everything up in memory.
+    '''
+    def __init__(self, name, handle, workers=1, queue_size=256):
+        self.name = name
+        self.handle = handle
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.received = 0
+        self.emitted = 0
+        self.errors = 0
+        self.latencies = []
+        self.blocked = 0.0  # seconds spent waiting for room downstream
+        self.started = None
+        self.finished = None
+
+    async def worker(self, output):
+        while True:
+            item = await self.queue.get()
+            if item is DONE:
+                await self.queue.put(DONE)  # let the other workers see it too
+                return
+            self.received += 1
+            STAGE_ITEMS.inc(stage=self.name)
+            start = time.monotonic()
+            blocked = 0.0
+            try:
+                async for out in self.handle(item):
+                    if output is not None:
+                        wait = time.monotonic()
+                        await output.put(out)
+                        blocked += time.monotonic() - wait
+                    self.emitted += 1
+            except Exception as e:
+                self.errors += 1
+                STAGE_ERRORS.inc(stage=self.name)
+                print(f'{self.name}: {e}')
+            self.blocked += blocked
+            self.latencies.append(time.monotonic() - start - blocked)
+            STAGE_SECONDS.observe(self.latencies[-1], stage=self.name)
+
+    async def run(self, output):
+        self.started = time.monotonic()
+        await asyncio.gather(*(self.worker(output) for _ in range(self.workers)))
+        self.finished = time.monotonic()
+        if output is not None:
+            await output.put(DONE)
+
+    def report(self):
+        elapsed = max((self.finished or time.monotonic()) - self.started, 1e-9)
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'in': self.received,
+            'out': self.emitted,
+            'errors': self.errors,
+            'items/s': round(self.received / elapsed, 2),
+            'mean ms': round(1000 * sum(self.latencies) / max(len(self.latencies), 1), 1),
+            'p50 ms': round(1000 * percentile(self.latencies, 0.5), 1),
+            'p95 ms': round(1000 * percentile(self.latencies, 0.95), 1),
+            'blocked s': round(self.blocked, 1),
+        }
+
+async def run_pipeline(inputs, stages):
+    '''Feeds inputs to the first stage and runs every stage until all are drained.'''
+    async def feed():
+        for item in inputs:
+            await stages[0].queue.put(item)
+        await stages[0].queue.put(DONE)
+
+    outputs = [stage.queue for stage in stages[1:]] + [None]
+    await asyncio.gather(feed(), *(stage.run(output) for stage, output in zip(stages, outputs)))
+
+def print_report(stages):
+    rows = [stage.report() for stage in stages]
+    columns = list(rows[0])
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+def parse_source(task):
+    # runs in a sandbox worker, so the time goes back with the result; (analysis, seconds),
+    # with analysis None for a file that does not parse. Parse errors are caught here, so
+    # that a failure the sandbox reports always means the file hung, blew the memory cap
+    # or crashed the worker, never that it is broken
+    body, notebook = task
+    start = time.monotonic()
+    try:
+        if notebook:
+            interactions, calls = find_notebook_calls(*read_notebook(io.BytesIO(body)))
+        else:
+            interactions, calls = find_llm_calls(decode_source(body))
+        analysis = {"create_calls": interactions, "calls": calls}
+    except Exception:
+        analysis = None
+    return analysis, time.monotonic() - start
+
+def code_of(repo_fn, body):
+    if repo_fn.endswith('.ipynb'):
+        return read_notebook(io.BytesIO(body))[0]
+    return source_text(decode_source(body))
+
+class Pipeline:
+    '''
+    search -> download -> parse -> filter [-> classify] as one run. Every stage
+    keeps writing the files the standalone scripts read: the search checkpoint
+    under output/, downloads under repos/ and repos/repos.txt, parse records to
+    a jsonl file and, with classification on, answers to another. A rerun adds
+    no second line or record for a file those already have, and does not
+    classify a file again once its answers are written.
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.repos_file = None
+        self.parse_out = None
+        self.answers_out = None
+        self.profiler = cProfile.Profile() if args.profile else None
+
+    async def search(self, query):
+        from repo_search import Harvester, unseen_items  # reads the github token on import
+
+        pages = asyncio.Queue(1)
+        seen = set()
+        harvester = Harvester(query, f'output/{query}_{self.args.pages * 100}.checkpoint.jsonl',
+                              max_pages=self.args.pages, on_page=pages.put, per_host_rate=self.args.per_host_rate)
+
+        async def harvest():
+            try:
+                await harvester.run()
+            finally:
+                await pages.put(None)
+
+        task = asyncio.ensure_future(harvest())
+        for item in harvester.results(seen):  # pages a previous run already fetched
+            yield item
+        while (items := await pages.get()) is not None:
+            for item in unseen_items(items, seen):
+                yield item
+        await task
+
+    async def download(self, item):
+        repo_name, repo_path = item
+        repo_path = repo_path.replace(' ', '%20')
+        res = await self.fetcher.fetch_first(raw_url_candidates(repo_name, repo_path))
+        if res is None:
+            raise Exception(f'unable to download {repo_name}/{repo_path}')
+        repo_fn = save_download(repo_name, repo_path, res)
+        line = str((repo_fn, repo_name, repo_path))
+        if line not in self.known_repos:  # as analyse_code.append_repos, a rerun adds no duplicates
+            self.known_repos.add(line)
+            self.repos_file.write(line + '\n')
+            self.repos_file.flush()
+        yield res.url, repo_fn, res.body
+
+    async def parse(self, item):
+        url, repo_fn, body = item
+        if not repo_fn.endswith(SOURCE_SUFFIXES):
+            return
+        if not PREFILTER.match(body):
+            record_outcome(None, None)
+            self.parse_out.write({"url": url, "skipped": True})
+            return
+        notebook = repo_fn.endswith('.ipynb')
+        sha256 = hashlib.sha256(body).hexdigest() if self.manifest else None
+        found, analysis = self.manifest.get(sha256, Finder.VERSION) if self.manifest else (False, None)
+        if found:
+            record_outcome(analysis, analysis is None, source='manifest')
+        elif f'repos/{repo_fn}' in self.quarantine:
+            PARSE_FILES.inc(outcome='quarantined')
+            error = f'quarantined {repo_fn}: {self.quarantine.reason(f"repos/{repo_fn}")}'
+            self.parse_out.write({"url": url, "error": error})
+            raise Exception(error)
+        else:
+            if self.profiler:  # in this process, so the profiler sees ast.parse and Finder
+                failure, outcome = None, self.profiler.runcall(parse_source, (body, notebook))
+            elif self.sandbox is None:
+                failure, outcome = None, parse_source((body, notebook))
+            else:
+                failure, outcome = await self.sandbox.run(parse_source, (body, notebook))
+            if failure:
+                # kept out of later runs, but not in the manifest, which only holds what the file itself gave
+                PARSE_FILES.inc(outcome='quarantined')
+                self.quarantine.add(f'repos/{repo_fn}', failure, url=url)
+                error = f'quarantined {repo_fn}: {failure}'
+                self.parse_out.write({"url": url, "error": error})
+                raise Exception(error)
+            analysis, seconds = outcome
+            record_outcome(analysis, analysis is None, seconds)
+            if self.manifest:
+                self.manifest.put(sha256, Finder.VERSION, analysis)
+        if analysis is None:
+            self.parse_out.write({"url": url, "error": f'error in {repo_fn}'})
+            raise Exception(f'error in {repo_fn}')
+        result = {"url": url, **analysis}
+        self.parse_out.write(result)
+        yield result, repo_fn, body
+
+    async def filter(self, item):
+        if is_relevant(item[0]):
+            yield item
+
+    async def classify(self, item):
+        # as in ask_openai.py: with --static, files the AST answers with confidence are
+        # not sent, and with --dedup a near-duplicate of an earlier file gets its answers
+        result, repo_fn, body = item
+        url = result["url"]
+        if url in self.answers_out:  # answered by an earlier run
+            yield url
+            return
+        code = code_of(repo_fn, body)
+        if self.args.static:
+            answers, confident = classify_code(code)
+            if confident:
+                self.answers_out.write({"url": url, "answers": [], "consensus": answers, "static": True})
+                yield url
+                return
+        if self.args.token_budget:
+            code = slice_source(code, self.args.token_budget, self.args.model)
+        if self.dedup:
+            rep = self.dedup.add(url, code)
+            if rep != url:
+                # the representative may still be in flight, its future resolves with its answers
+                record = await self.dedup.results[rep]
+                if record is None:
+                    raise Exception(f'unable to classify {url}: its representative {rep} failed')
+                self.answers_out.write({**record, "url": url, "duplicate_of": rep})
+                yield url
+                return
+            self.dedup.results[url] = asyncio.get_running_loop().create_future()
+        record = None
+        try:
+            messages = classification_messages(code)
+            min_agree = self.args.min_agree
+            if min_agree:
+                responses = await self.classifier.sample_until(
+                    messages, self.args.samples, lambda responses: consensus(responses, min_agree)[2], min_agree)
+            else:
+                responses = await self.classifier.sample(messages, self.args.samples)
+            answers, agreement, _ = consensus(responses, min_agree)
+            record = {"url": url, "answers": responses, "consensus": answers, "agreement": agreement}
+        finally:
+            if self.dedup:
+                self.dedup.results[url].set_result(record)
+        self.answers_out.write(record)
+        yield url
+
+    def stages(self):
+        args = self.args
+        stages = []
+        if args.query:
+            stages.append(Stage('search', self.search, 1, args.queue_size))
+        stages += [
+            Stage('download', self.download, args.download_workers, args.queue_size),
+            Stage('parse', self.parse, args.parse_workers or os.cpu_count(), args.queue_size),
+            Stage('filter', self.filter, 1, args.queue_size),
+        ]
+        if args.classify:
+            stages.append(Stage('classify', self.classify, args.classify_workers, args.queue_size))
+        return stages
+
+    async def run(self, stages):
+        args = self.args
+        inputs = [args.query] if args.query else read_search_output(args.search_output)
+        async with Fetcher(concurrency=args.download_workers, per_host_rate=args.per_host_rate, cache=self.cache) as fetcher:
+            self.fetcher = fetcher
+            await run_pipeline(inputs, stages)
+
+    def main(self):
+        args = self.args
+        os.makedirs('repos', exist_ok=True)
+        os.makedirs('output', exist_ok=True)
+        self.cache = BlobCache(args.cache_dir)
+        self.manifest = None if args.full else Manifest(args.manifest)
+        workers = args.parse_workers or os.cpu_count()
+        options = None if self.profiler else sandbox_options(args, workers)
+        self.sandbox = SandboxPool(workers, **options) if options is not None else None
+        self.quarantine = open_quarantine(args)
+        self.known_repos = known_repos()
+        self.repos_file = open('repos/repos.txt', 'a')
+        self.parse_out = JsonlWriter(args.jsonl, key='url')
+        if args.classify:
+            with open('openai_token', 'r') as f:
+                api_key = f.readline().strip()
+            self.response_cache = ResponseCache(args.llm_cache)
+            self.answers_out = JsonlWriter(args.answers, key='url')
+            self.dedup = LSHIndex(args.dedup) if args.dedup else None
+            self.classifier = Classifier(
+                model=args.model, concurrency=args.classify_workers, requests_per_minute=args.rpm,
+                tokens_per_minute=args.tpm, cache=self.response_cache, api_key=api_key,
+                api_base=args.api_base,
+            )
+        stages = self.stages()
+        stop_metrics = start_metrics(args)
+        try:
+            asyncio.run(self.run(stages))
+        finally:
+            stop_metrics()
+            if self.profiler:
+                self.profiler.dump_stats(args.profile)
+            if self.sandbox:
+                self.sandbox.shutdown()
+            self.quarantine.close()
+            self.cache.close()
+            if self.manifest:
+                self.manifest.close()
+            self.repos_file.close()
+            self.parse_out.close()
+            if args.classify:
+                self.answers_out.close()
+                self.response_cache.close()
+        print_report(stages)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run search, download, parse, filter and classify as one streaming pipeline.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--query', help='github code search query to start from')
+    source.add_argument('--search-output', metavar='PATH', help='start from a repo_search.py output file instead')
+    parser.add_argument('--pages', type=int, default=10, help='search result pages to fetch for --query')
+    parser.add_argument('--queue-size', type=int, default=256, help='items waiting in front of each stage')
+    parser.add_argument('--download-workers', type=int, default=32)
+    add_fetch_arguments(parser)
+    parser.add_argument('--parse-workers', type=int, default=0, help='processes for parsing (0 = all cores)')
+    parser.add_argument('--classify-workers', type=int, default=8)
+    add_sandbox_arguments(parser)
+    parser.add_argument('--cache-dir', default='cache', help='blob cache for downloads')
+    parser.add_argument('--manifest', default='manifest.sqlite', help='past analyses, reused for unchanged files')
+    parser.add_argument('--full', action='store_true', help='ignore the manifest and reanalyse every file')
+    parser.add_argument('--jsonl', default='parse.jsonl', help='parse records are appended here')
+    parser.add_argument('--classify', action='store_true', help='send relevant files to the openai api')
+    parser.add_argument('--answers', default='answers.jsonl', help='classification answers are appended here')
+    parser.add_argument('--samples', type=int, default=5, help='most completions requested per file')
+    parser.add_argument('--min-agree', type=int, default=2, metavar='N',
+                        help='stop sampling a file once every answer has N agreeing samples and a majority, '
+                             '0 always takes --samples')
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    parser.add_argument('--rpm', type=int, default=3500, help='requests per minute')
+    parser.add_argument('--tpm', type=int, default=90000, help='tokens per minute')
+    parser.add_argument('--llm-cache', default='llm_cache.sqlite', help='on-disk response cache')
+    parser.add_argument('--api-base', help='e.g. a local mock server')
+    parser.add_argument('--token-budget', type=int, default=2000, help='max code tokens per file, 0 sends whole files')
+    parser.add_argument('--static', action='store_true',
+                        help='answer from the AST where it is certain and only send the other files to the api')
+    parser.add_argument('--dedup', type=float, metavar='THRESHOLD',
+                        help='classify only the first of each group of files with at least this estimated similarity '
+                             '(e.g. 0.9) and give the others its answers')
+    parser.add_argument('--profile', metavar='PATH', help='parse in this process under cProfile and write the stats to PATH')
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
+def main():
+    Pipeline(parse_args(sys.argv[1:])).main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import re
+import unicodedata
+
+from ingest import NON_ASCII, map_file
+from patterns import PATTERNS
+
+def required_tokens(patterns=PATTERNS):
+    '''
+    Groups of identifiers a source must contain to match any pattern: one of the
+    attributes in front of the called method, and one of the method names. A
+    token that contains another token of its group is dropped as redundant.
+    '''
+    groups = [{pattern.chain[-2] for pattern in patterns}, {pattern.chain[-1] for pattern in patterns}]
+    return [sorted(token for token in group if not any(other != token and other in token for other in group))
+            for group in groups]
+
+class Prefilter:
+    '''
+    Byte-level check that runs before ast.parse. A file is only skipped when it
+    lacks every token of some group, which Finder cannot match without, so
+    no file with a matching call is ever dropped.
+    '''
+    def __init__(self, patterns=PATTERNS):
+        self.groups = required_tokens(patterns)
+        self.byte_regexes = [re.compile(b'|'.join(re.escape(token.encode()) for token in group)) for group in self.groups]
+        self.str_regexes = [re.compile('|'.join(re.escape(token) for token in group)) for group in self.groups]
+
+    def match(self, data):
+        if all(regex.search(data) for regex in self.byte_regexes):
+            return True
+        # python NFKC-normalizes identifiers, so e.g. fullwidth letters still spell
+        # `create`; only sources with non-ascii bytes need the slower check
+        if not NON_ASCII.search(data):
+            return False
+        text = unicodedata.normalize('NFKC', bytes(data).decode('utf-8', errors='replace'))
+        return all(regex.search(text) for regex in self.str_regexes)
+
+    def match_file(self, path):
+        with map_file(path) as data:
+            return bool(data) and self.match(data)
+
+PREFILTER = Prefilter()
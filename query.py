@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import argparse
+import re
+import sys
+
+import pyarrow.dataset as ds
+
+from store import ROOT, SCHEMAS, open_table
+
+CONDITION = re.compile(r'^\s*(\w+)\s*(==|=|!=|<=|>=|<|>)\s*(.*?)\s*$')
+OPERATORS = {
+    '=': lambda field, value: field == value,
+    '==': lambda field, value: field == value,
+    '!=': lambda field, value: field != value,
+    '<': lambda field, value: field < value,
+    '<=': lambda field, value: field <= value,
+    '>': lambda field, value: field > value,
+    '>=': lambda field, value: field >= value,
+}
+
+def parse_value(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text.strip('\'"')
+
+def parse_condition(text):
+    '''`column op value` as a dataset expression, e.g. `placement = end`.'''
+    match = CONDITION.match(text)
+    if not match:
+        raise ValueError(f'bad condition: {text!r}')
+    column, op, value = match.groups()
+    return OPERATORS[op](ds.field(column), parse_value(value))
+
+def query(table, where=(), columns=None, group_by=None, count=False, run=None, root=ROOT):
+    '''
+    Filters are pushed down to the parquet scan, so row groups and run
+    partitions that cannot match are skipped, and only the selected columns,
+    the group keys and the filtered columns are ever read.
+    '''
+    dataset = open_table(table, root)
+    conditions = [parse_condition(condition) for condition in where]
+    if run:
+        conditions.append(ds.field('run') == run)
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    if group_by:
+        result = dataset.to_table(columns=group_by, filter=expression)
+        result = result.group_by(group_by).aggregate([([], 'count_all')])
+        return result.sort_by([('count_all', 'descending')])
+    if count:
+        return dataset.count_rows(filter=expression)
+    return dataset.to_table(columns=columns, filter=expression)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Query the parquet results written by parse.py, analysis.py and ask_openai.py.')
+    parser.add_argument('table', choices=sorted(SCHEMAS))
+    parser.add_argument('--where', action='append', default=[],
+                        help='condition like "placement = end" or "insertions > 0", may be repeated')
+    parser.add_argument('--columns', help='comma separated columns to show')
+    parser.add_argument('--group-by', help='comma separated columns to count rows by')
+    parser.add_argument('--count', action='store_true', help='only print the number of matching rows')
+    parser.add_argument('--run', help='only look at this run')
+    parser.add_argument('--root', default=ROOT, help='directory the results were written to')
+    parser.add_argument('--limit', type=int, default=20, help='rows to print, 0 for all')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    result = query(
+        args.table, args.where,
+        columns=args.columns.split(',') if args.columns else None,
+        group_by=args.group_by.split(',') if args.group_by else None,
+        count=args.count, run=args.run, root=args.root,
+    )
+    if args.count and not args.group_by:
+        print(result)
+        return
+    frame = (result.slice(0, args.limit) if args.limit else result).to_pandas()
+    print(frame.to_string(index=False))
+    if args.limit and result.num_rows > args.limit:
+        print(f'... {result.num_rows - args.limit} more rows')
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,255 @@
 #!/usr/bin/env python3
 
-import requests
+import argparse
+import asyncio
 import json
-from bs4 import BeautifulSoup
-from pathlib import Path
+import math
+import os
 import time
 import sys
-from datetime import datetime
+
+from fetch import FetchError, Fetcher, add_arguments as add_fetch_arguments
+from jsonl import count_complete_records
 
 with open('github_token', 'r') as f:
-    TOKEN = f.readline()
+    TOKEN = f.readline().strip()
 
 ACCEPT = 'application/vnd.github+json'
 AUTHORISATION = f'Bearer {TOKEN}'
 GITHUB_API_VERSION = '2022-11-28'
 HEADERS = {'Accept': ACCEPT, 'Authorization': AUTHORISATION, 'X-GitHub-Api-Version': GITHUB_API_VERSION}
 
-query = sys.argv[1]
-num_pages = int(sys.argv[2])
-url = f'https://api.github.com/search/code?q={query}&ref=advsearch&per_page=100&page='
-
-repos = {}
-with requests.session() as s:
-    for page in range(1, num_pages+1):
-        while True: # sleep the timeout
-            res = s.get(url + str(page), headers=HEADERS)
-            if res.status_code != 200:
-                time.sleep(5)
+SEARCH_URL = 'https://api.github.com/search/code'
+MAX_RESULTS = 1000      # github never returns more than this for one query
+MAX_FILE_SIZE = 384000  # larger files are not indexed by code search
+PER_PAGE = 100
+MAX_PAGES = MAX_RESULTS // PER_PAGE  # pages one query can reach
+
+class RateLimit:
+    '''
+    Schedules requests from github's X-RateLimit-Remaining/Reset headers: no more
+    requests are in flight than the window has left, and a Retry-After or an empty
+    window pauses everyone until the server says otherwise.
+    '''
+    def __init__(self):
+        self.remaining = None
+        self.reset = 0
+        self.pause_until = 0
+        self.in_flight = 0
+
+    async def acquire(self):
+        while True:
+            now = time.time()
+            if self.pause_until > now:
+                await asyncio.sleep(self.pause_until - now)
                 continue
-            break   
-        res_json = json.loads(str(res.content, 'utf-8'))
-        res_items = res_json['items']
-        for repo in res_items:
-            repo_path = repo['path']
-            if repo_path[-3:] == '.md': # skip markdown files
+            if self.remaining is None:
+                if self.in_flight == 0:  # learn the budget from a first request
+                    break
+            elif self.remaining - self.in_flight > 0:
+                break
+            elif self.reset > now:
+                await asyncio.sleep(self.reset - now + 1)
+                self.remaining = None
+                continue
+            else:  # the window ran out and has since reset
+                self.remaining = None
+                continue
+            await asyncio.sleep(0.1)
+        self.in_flight += 1
+
+    def release(self, headers):
+        self.in_flight -= 1
+        now = time.time()
+        if 'X-RateLimit-Remaining' in headers:
+            remaining, reset = int(headers['X-RateLimit-Remaining']), int(headers['X-RateLimit-Reset'])
+            # responses can arrive out of order, only a newer window may raise the count
+            if reset > self.reset or self.remaining is None:
+                self.remaining, self.reset = remaining, reset
+            else:
+                self.remaining = min(self.remaining, remaining)
+        if 'Retry-After' in headers:
+            self.pause_until = max(self.pause_until, now + float(headers['Retry-After']))
+        elif self.remaining == 0:
+            self.pause_until = max(self.pause_until, self.reset + 1)
+
+class Harvester:
+    '''
+    Pages through code search results for a query. Queries with more than 1000
+    hits are split into file size ranges until each range fits under the cap.
+    Every page is appended to a jsonl checkpoint as soon as it arrives, and a
+    rerun with the same checkpoint only fetches what is missing. on_page, if
+    given, is awaited with the items of every newly fetched page.
+    '''
+    def __init__(self, query, checkpoint, max_pages=None, concurrency=4, on_page=None, per_host_rate=None):
+        self.query = query
+        self.checkpoint = checkpoint
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.per_host_rate = per_host_rate
+        self.on_page = on_page
+        self.rate_limit = RateLimit()
+        self.totals = {}
+        self.done = set()
+        self.load_checkpoint()
+
+    def load_checkpoint(self):
+        if not count_complete_records(self.checkpoint):  # also drops a torn last line
+            return
+        with open(self.checkpoint) as f:
+            for line in f:
+                record = json.loads(line)
+                size_range = tuple(record['range'])
+                if 'total' in record:
+                    self.totals[size_range] = record['total']
+                else:
+                    self.done.add((size_range, record['page']))
+
+    def record(self, record):
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    def page_url(self, size_range, page):
+        lo, hi = size_range
+        return f'{SEARCH_URL}?q={self.query}+size:{lo}..{hi}&per_page={PER_PAGE}&page={page}'
+
+    async def get(self, fetcher, size_range, page):
+        # None once fetcher.retries rate limited attempts are used up; a 403 that is not
+        # a rate limit (a blocked repository, a token without the scope) ends the run
+        for _ in range(fetcher.retries + 1):
+            await self.rate_limit.acquire()
+            try:
+                res = await fetcher.fetch(self.page_url(size_range, page))
+            except FetchError as e:
+                self.rate_limit.release({})
+                print(f'unable to fetch {size_range} page {page}: {e}')
+                return None
+            self.rate_limit.release(res.headers)
+            if res.status in (403, 429):
+                headers_say_so = 'Retry-After' in res.headers or res.headers.get('X-RateLimit-Remaining') == '0'
+                if res.status == 403 and not headers_say_so and b'rate limit' not in res.body.lower():
+                    raise FetchError(f'code search refused with 403: {str(res.body, "utf-8", "replace")[:200]}')
+                # secondary rate limits may come without headers, back off a minute
+                if not headers_say_so:
+                    self.rate_limit.pause_until = max(self.rate_limit.pause_until, time.time() + 60)
                 continue
-            repo_name = repo['repository']['full_name']
-            repo_id = repo['repository']['id']
-            repos[str(repo_id) + repo_path] = (repo_name, repo_path)
+            if res.status != 200:
+                print(f'unable to fetch {size_range} page {page}: {res.status}')
+                return None
+            return json.loads(str(res.body, 'utf-8'))
+        print(f'unable to fetch {size_range} page {page}: still rate limited after {fetcher.retries + 1} attempts')
+        return None
+
+    async def save_page(self, size_range, page, res_json):
+        items = [[item['repository']['id'], item['repository']['full_name'], item['path']]
+                 for item in res_json['items']]
+        self.record({'range': size_range, 'page': page, 'items': items})
+        self.done.add((tuple(size_range), page))
+        if self.on_page:
+            await self.on_page(items)
+
+    def splits(self, size_range, budget):
+        # a range over the cap still serves its first MAX_PAGES pages, so it is only
+        # split when the budget asks for more than that
+        lo, hi = size_range
+        return self.totals[size_range] > MAX_RESULTS and lo < hi and (budget is None or budget > MAX_PAGES)
+
+    async def plan(self, fetcher, size_range, budget=None):
+        '''
+        The (range, page) pairs to fetch, at most budget of them, splitting ranges
+        over the cap. With a budget the halves are planned one after the other,
+        and the upper one not at all once the lower one covers the budget.
+        '''
+        if size_range not in self.totals:
+            res_json = await self.get(fetcher, size_range, 1)
+            if res_json is None:
+                return []
+            self.totals[size_range] = res_json['total_count']
+            self.record({'range': size_range, 'total': res_json['total_count']})
+            if not self.splits(size_range, budget):
+                await self.save_page(size_range, 1, res_json)
+
+        lo, hi = size_range
+        if self.splits(size_range, budget):
+            mid = (lo + hi) // 2
+            if budget is None:
+                halves = await asyncio.gather(self.plan(fetcher, (lo, mid)), self.plan(fetcher, (mid + 1, hi)))
+                return halves[0] + halves[1]
+            pages = await self.plan(fetcher, (lo, mid), budget)
+            if len(pages) < budget:
+                pages += await self.plan(fetcher, (mid + 1, hi), budget - len(pages))
+            return pages
+        pages = math.ceil(min(self.totals[size_range], MAX_RESULTS) / PER_PAGE)
+        return [(size_range, page) for page in range(1, min(pages, budget or pages) + 1)]
+
+    async def run(self):
+        self.out = open(self.checkpoint, 'a')
+        try:
+            async with Fetcher(concurrency=self.concurrency, per_host_rate=self.per_host_rate, headers=HEADERS,
+                               retry_statuses={500, 502, 503, 504}) as fetcher:
+                await self.fetch_all(fetcher)
+        finally:
+            self.out.close()
+
+    async def fetch_all(self, fetcher):
+        pages = await self.plan(fetcher, (0, MAX_FILE_SIZE), self.max_pages)
+        todo = [(size_range, page) for size_range, page in pages if (size_range, page) not in self.done]
+        print(f'{len(pages)} pages in {len(self.totals)} ranges, {len(todo)} left to fetch')
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async def fetch_page(size_range, page):
+            async with semaphore:
+                res_json = await self.get(fetcher, size_range, page)
+            if res_json is not None:
+                await self.save_page(size_range, page, res_json)
+        await asyncio.gather(*(fetch_page(size_range, page) for size_range, page in todo))
+
+    def results(self, seen=None):
+        # read back from the checkpoint, deduplicated by repository id and path
+        seen = set() if seen is None else seen
+        if not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            for line in f:
+                record = json.loads(line)
+                yield from unseen_items(record.get('items', []), seen)
+
+def unseen_items(items, seen):
+    for repo_id, repo_name, repo_path in items:
+        if repo_path[-3:] == '.md': # skip markdown files
+            continue
+        key = str(repo_id) + repo_path
+        if key not in seen:
+            seen.add(key)
+            yield repo_name, repo_path
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Collect the files github code search finds for a query into output/.')
+    parser.add_argument('query')
+    parser.add_argument('num_pages', type=int, help=f'result pages of {PER_PAGE} to fetch')
+    add_fetch_arguments(parser)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    query, num_pages = args.query, args.num_pages
+
+    harvester = Harvester(query, f'output/{query}_{num_pages * 100}.checkpoint.jsonl', max_pages=num_pages,
+                          per_host_rate=args.per_host_rate)
+    try:
+        asyncio.run(harvester.run())
+    except FetchError as e:
+        print(e)
+        sys.exit(1)
 
-print(f'{len(list(repos.keys()))} repositories found.')
-print('writing to file...', end='')
+    print('writing to file...', end='')
+    count = 0
+    with open(f'output/{query}_{num_pages * 100}.txt', 'w') as f:
+        for repo_url, repo_path in harvester.results():
+            f.write(f'{repo_url} {repo_path}\n')
+            count += 1
+    print('done.')
+    print(f'{count} repositories found.')
 
-with open(f'output/{query}_{num_pages * 100}.txt', 'w') as f:
-    for repo_url, repo_path in repos.values():
-        f.write(f'{repo_url} {repo_path}\n')
-print('done.')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+from jsonl import JsonlWriter, read_jsonl
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss_bytes(pid):
+    # resident set size from /proc; None where there is no /proc, which disables the cap
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+def worker_main(conn):
+    func = None
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        index, new_func, item = task
+        func = new_func or func  # the function is only sent when it changes
+        try:
+            outcome = None, func(item)
+        except MemoryError:
+            outcome = 'out of memory', None
+        except Exception as e:
+            outcome = f'{type(e).__name__}: {e}', None
+        try:
+            conn.send((index, outcome))
+        except Exception as e:  # e.g. an unpicklable result
+            conn.send((index, (f'{type(e).__name__}: {e}', None)))
+
+class Worker:
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.tasks = 0
+        self.func = None
+        self.job = None  # (index, item, deadline) while busy
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class SandboxPool:
+    '''
+    Worker processes that each run one task at a time. A task that runs past
+    timeout seconds, grows its worker beyond max_rss_mb or kills its worker
+    outright is reported as failed with the reason, and the worker is replaced;
+    the other tasks carry on. Workers are also recycled every
+    max_tasks_per_worker tasks so slow leaks cannot build up.
+    '''
+    def __init__(self, workers=1, timeout=60, max_rss_mb=2048, max_tasks_per_worker=1000, poll_interval=0.25):
+        self.context = multiprocessing.get_context()
+        self.timeout = timeout
+        self.max_rss = max_rss_mb * 1024 * 1024 if max_rss_mb else None
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.poll_interval = poll_interval
+        self.workers = [Worker(self.context) for _ in range(workers)]
+        self.restarts = 0
+        self.idle = None  # workers free for run(), made on its first call
+
+    def replace(self, worker, kill=True):
+        worker.kill() if kill else worker.stop()
+        new = Worker(self.context)
+        self.workers[self.workers.index(worker)] = new
+        if kill:
+            self.restarts += 1
+        return new
+
+    async def run(self, func, item):
+        '''
+        Runs func on one item from asyncio, under the same limits as map:
+        (failure, result). Each task takes a whole worker, callers beyond the
+        number of workers wait for one to come free. map and run must not be
+        used at the same time.
+        '''
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for worker in self.workers:
+                self.idle.put_nowait(worker)
+        loop = asyncio.get_running_loop()
+        worker = await self.idle.get()
+        try:
+            worker.conn.send((0, None if worker.func is func else func, item))
+            worker.func = func
+            worker.tasks += 1
+            deadline = time.monotonic() + self.timeout if self.timeout else None
+            while True:
+                wait_for = self.poll_interval
+                if deadline:
+                    wait_for = max(0, min(wait_for, deadline - time.monotonic()))
+                if await loop.run_in_executor(None, worker.conn.poll, wait_for):
+                    try:
+                        _, outcome = worker.conn.recv()
+                    except (EOFError, OSError):
+                        code = worker.process.exitcode
+                        if code is None:
+                            worker.process.join(1)
+                            code = worker.process.exitcode
+                        worker = self.replace(worker)
+                        return f'worker died (exit code {code})', None
+                    if self.max_tasks_per_worker and worker.tasks >= self.max_tasks_per_worker:
+                        worker = self.replace(worker, kill=False)
+                    return outcome
+                if deadline and time.monotonic() > deadline:
+                    worker = self.replace(worker)
+                    return f'timed out after {self.timeout}s', None
+                if self.max_rss and (rss_bytes(worker.process.pid) or 0) > self.max_rss:
+                    worker = self.replace(worker)
+                    return f'rss over {self.max_rss // (1024 * 1024)} MB', None
+        except asyncio.CancelledError:
+            worker = self.replace(worker)  # it may still be busy with the task
+            raise
+        finally:
+            self.idle.put_nowait(worker)
+
+    def map(self, func, items):
+        '''
+        Runs func over items, yielding (failure, result) in input order, where
+        failure is None or the reason the task did not complete.
+        '''
+        pending = deque(enumerate(items))
+        done = {}
+        next_index = 0
+        rss_checked = time.monotonic()
+        while pending or any(worker.job for worker in self.workers):
+            for worker in self.workers:
+                if worker.job is None and pending:
+                    index, item = pending.popleft()
+                    worker.conn.send((index, None if worker.func is func else func, item))
+                    worker.func = func
+                    worker.job = index, item, time.monotonic() + self.timeout if self.timeout else None
+                    worker.tasks += 1
+
+            busy = [worker for worker in self.workers if worker.job]
+            deadlines = [worker.job[2] for worker in busy if worker.job[2]]
+            wait_for = self.poll_interval
+            if deadlines:
+                wait_for = max(0, min(wait_for, min(deadlines) - time.monotonic()))
+            ready = wait([worker.conn for worker in busy], wait_for)
+            check_rss = self.max_rss and time.monotonic() - rss_checked >= self.poll_interval
+            if check_rss:
+                rss_checked = time.monotonic()
+
+            for worker in busy:
+                index = worker.job[0]
+                if worker.conn in ready:
+                    try:
+                        _, outcome = worker.conn.recv()
+                    except (EOFError, OSError):
+                        code = worker.process.exitcode
+                        if code is None:
+                            worker.process.join(1)
+                            code = worker.process.exitcode
+                        done[index] = f'worker died (exit code {code})', None
+                        worker.job = None
+                        self.replace(worker)
+                        continue
+                    done[index] = outcome
+                    worker.job = None
+                    if self.max_tasks_per_worker and worker.tasks >= self.max_tasks_per_worker:
+                        self.replace(worker, kill=False)
+                elif worker.job[2] and time.monotonic() > worker.job[2]:
+                    done[index] = f'timed out after {self.timeout}s', None
+                    worker.job = None
+                    self.replace(worker)
+                elif check_rss and (rss_bytes(worker.process.pid) or 0) > self.max_rss:
+                    done[index] = f'rss over {self.max_rss // (1024 * 1024)} MB', None
+                    worker.job = None
+                    self.replace(worker)
+
+            while next_index in done:
+                yield done.pop(next_index)
+                next_index += 1
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.stop()
+
+class Quarantine:
+    '''
+    Files that timed out, ran out of memory or crashed a worker, with the
+    reason, kept in a jsonl file so that later runs skip them.
+    '''
+    def __init__(self, path='quarantine.jsonl', load=True):
+        self.path = path
+        self.reasons = {}
+        if load and os.path.exists(path):
+            for record in read_jsonl(path):
+                self.reasons[record['path']] = record['reason']
+        self.writer = None
+
+    def __contains__(self, path):
+        return path in self.reasons
+
+    def reason(self, path):
+        return self.reasons[path]
+
+    def add(self, path, reason, **extra):
+        if self.writer is None:
+            self.writer = JsonlWriter(self.path, fsync_every=1)
+        self.reasons[path] = reason
+        self.writer.write({'path': path, 'reason': reason, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **extra})
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+def add_arguments(parser):
+    parser.add_argument('--timeout', type=float, default=60, help='seconds a worker may spend on one file before it is killed')
+    parser.add_argument('--max-rss-mb', type=int, default=2048, help='resident memory a worker may reach before it is killed')
+    parser.add_argument('--quarantine', default='quarantine.jsonl', help='files that hung, ran out of memory or crashed a worker')
+    parser.add_argument('--retry-quarantined', action='store_true', help='parse quarantined files again instead of skipping them')
+    parser.add_argument('--in-process', action='store_true', help='with a single worker, parse in this process without a sandbox')
+
+def options(args, workers=1):
+    '''SandboxPool keyword arguments for the --timeout/--max-rss-mb options, None to parse in this process.'''
+    if args.in_process and workers == 1:
+        return None
+    return {"timeout": args.timeout, "max_rss_mb": args.max_rss_mb}
+
+def open_quarantine(args):
+    return Quarantine(args.quarantine, load=not args.retry_quarantined)
@@ -0,0 +1,119 @@
+import ast
+
+from classifier import count_tokens
+from ingest import decode_source, map_file, read_notebook, source_text
+from parse import SOURCE_LINE, Finder
+
+GAP = '# ...\n'
+INPUT_FUNCTIONS = {'input', 'open', 'getenv', 'parse_args', 'read', 'readline', 'readlines'}
+INPUT_ATTRIBUTES = {('sys', 'argv'), ('sys', 'stdin'), ('os', 'environ')}
+
+def parent_map(tree):
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+    return parents
+
+def enclosing_statement(node, parents):
+    while not isinstance(node, ast.stmt) and node in parents:
+        node = parents[node]
+    return node
+
+def enclosing_functions(node, parents):
+    while node in parents:
+        node = parents[node]
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            yield node
+
+def header_span(node):
+    # the `def ...:` lines of a function or class, without its body
+    return node.lineno, max(node.lineno, node.body[0].lineno - 1)
+
+def is_input_source(node):
+    if isinstance(node, ast.Call):
+        func = node.func
+        name = func.id if isinstance(func, ast.Name) else getattr(func, 'attr', None)
+        return name in INPUT_FUNCTIONS
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+        return (node.value.id, node.attr) in INPUT_ATTRIBUTES
+    return False
+
+def slice_groups(tree, finder):
+    '''Line spans (1-based, inclusive) to keep, most important group first.'''
+    parents = parent_map(tree)
+    span = lambda node: (node.lineno, node.end_lineno)
+    calls = [enclosing_statement(call, parents) for call in finder.call_nodes]
+    chain = [header_span(node) if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) else span(node)
+             for node in finder.interaction_nodes]
+    inputs = [enclosing_statement(node, parents) for node in ast.walk(tree) if is_input_source(node)]
+    functions = sorted({function for node in calls + finder.interaction_nodes
+                        for function in enclosing_functions(node, parents)}, key=lambda node: node.lineno)
+    imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    return [
+        [span(node) for node in calls],
+        chain,
+        [span(node) for node in inputs],
+        [header_span(function) for function in functions],
+        sorted((span(function) for function in functions), key=lambda s: s[1] - s[0]),
+        [span(node) for node in imports],
+    ]
+
+def head(lines, costs, budget):
+    used, end = 0, 0
+    while end < len(lines) and used + costs[end] <= budget:
+        used += costs[end]
+        end += 1
+    return ''.join(lines[:end]) + (GAP if end < len(lines) else '')
+
+def slice_source(code, budget=2000, model='gpt-3.5-turbo'):
+    '''
+    Cuts code down to at most ~budget tokens, keeping what the classifier needs:
+    each LLM call, the assignment chain Finder traces from it, the argv/input
+    sources, then the enclosing functions and the imports. Code that already fits
+    is returned unchanged, and code Finder cannot handle is cut from the top.
+    '''
+    if count_tokens(code, model) <= budget:
+        return code
+    lines = SOURCE_LINE.findall(code)  # split the way ast numbers lines
+    costs = [count_tokens(line, model) for line in lines]
+    try:
+        tree = ast.parse(code)
+        finder = Finder(code)
+        finder.visit(tree)
+    except Exception:
+        return head(lines, costs, budget)
+    if not finder.call_nodes:
+        return head(lines, costs, budget)
+
+    gap_cost = count_tokens(GAP, model)
+    selected = set()
+    used = 0
+    for group in slice_groups(tree, finder):
+        for start, end in group:
+            new = [i for i in range(start - 1, end) if i not in selected]
+            cost = sum(costs[i] for i in new) + gap_cost
+            if new and used + cost <= budget:
+                selected.update(new)
+                used += cost
+    if not selected:  # even the first call is over budget
+        start = enclosing_statement(finder.call_nodes[0], parent_map(tree)).lineno - 1
+        return GAP + head(lines[start:], costs[start:], budget - gap_cost)
+
+    out = []
+    previous = -1
+    for i in sorted(selected):
+        if i != previous + 1:
+            out.append(GAP)
+        out.append(lines[i] if lines[i].endswith('\n') else lines[i] + '\n')
+        previous = i
+    if previous != len(lines) - 1:
+        out.append(GAP)
+    return ''.join(out)
+
+def read_code(path):
+    if path.endswith('.ipynb'):
+        with open(path, 'rb') as f:
+            return read_notebook(f)[0]
+    with map_file(path) as data:
+        return source_text(decode_source(data))
@@ -0,0 +1,246 @@
+import ast
+import builtins
+import re
+from collections import Counter, namedtuple
+
+from analysis import PLACEHOLDER, find_fstring_indices
+from parse import Finder
+from patterns import match_call
+from slicer import is_input_source
+
+# the fields of a transform_answers tuple
+QUESTIONS = ('system and user', 'dynamic', 'variables', 'static words', 'placement', 'steps')
+OPERATIONS = (ast.BinOp, ast.Subscript, ast.Call, ast.JoinedStr)
+MAX_STEPS = 2  # longer chains are where step counting conventions start to differ
+TOKEN = re.compile(r'\S+')
+
+# where a value comes from: kinds is a subset of {'input', 'parameter', 'unknown'}, steps
+# the operation nodes between an input and the value (a set, so that a value reached along
+# two paths counts once) and variables the names holding an input
+Flow = namedtuple('Flow', ['kinds', 'steps', 'variables'])
+STATIC = Flow(frozenset(), frozenset(), ())
+
+def is_format(node):
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'format'
+            and isinstance(node.func.value, ast.Constant) and isinstance(node.func.value.value, str))
+
+def prompt_word_starts(text):
+    # words as the examples in the prompt count them: whitespace separated, so "Don't"
+    # is one, and neither code fences nor bare punctuation count
+    return [token.start() for token in TOKEN.finditer(text)
+            if not token.group().startswith('```') and any(c.isalnum() for c in token.group())]
+
+def mostly_non_ascii(text):
+    letters = [c for c in text if c.isalpha()]
+    return bool(letters) and sum(not c.isascii() for c in letters) > len(letters) / 2
+
+class PromptFlow:
+    '''
+    Def-use view of one file for the classification questions: where each value
+    comes from (argv, input(), stdin and file reads, function parameters or
+    constants) and how many operations lie between an input and the value. Like
+    Finder it is flow-insensitive, a name stands for its last assignment.
+    '''
+    def __init__(self, tree, finder):
+        self.finder = finder
+        self.values = dict(finder.assigned_nodes)
+        self.functions = set()
+        self.appended = set()
+        # how many times each name is bound, by anything, and the names imports, defs and classes bind
+        self.bindings = Counter()
+        self.definitions = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                self.bindings[node.id] += 1
+            elif isinstance(node, ast.arg):
+                self.bindings[node.arg] += 1
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                self.bindings[node.name] += 1
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    name = alias.asname or alias.name.split('.')[0]
+                    self.bindings[name] += 1
+                    self.definitions.add(name)
+            if isinstance(node, (ast.With, ast.AsyncWith)):  # `with open(path) as f` binds f
+                for item in node.items:
+                    if isinstance(item.optional_vars, ast.Name):
+                        self.values.setdefault(item.optional_vars.id, item.context_expr)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                self.bindings[node.name] += 1
+                self.definitions.add(node.name)
+                if not isinstance(node, ast.ClassDef):
+                    self.functions.add(node.name)
+            elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                  and node.func.attr in ('append', 'extend', 'insert') and isinstance(node.func.value, ast.Name)):
+                self.appended.add(node.func.value.id)
+        self.flows = {}
+
+    def name_flow(self, name):
+        if name not in self.flows:
+            self.flows[name] = Flow(frozenset({'unknown'}), frozenset(), ())  # what a cycle sees
+            if name in self.values:
+                value = self.values[name]
+                flow = Flow(frozenset({'input'}), frozenset(), (name,)) if self.is_root_source(value) else self.flow(value)
+                if 'input' in flow.kinds and not flow.variables:  # the input is read in the value itself
+                    flow = flow._replace(variables=(name,))
+            elif name in self.finder.function_parameters:
+                flow = Flow(frozenset({'parameter'}), frozenset(), ())
+            elif name in self.definitions and self.bindings[name] == 1 or not self.bindings[name] and hasattr(builtins, name):
+                flow = STATIC
+            else:  # loop targets, unpacking, walrus and except names, or never bound here at all
+                flow = Flow(frozenset({'unknown'}), frozenset(), ())
+            if self.bindings[name] > 1:  # flow-insensitive, the last assignment need not be the one read
+                flow = flow._replace(kinds=flow.kinds | {'unknown'})
+            self.flows[name] = flow
+        return self.flows[name]
+
+    def flow(self, node):
+        if self.is_root_source(node):
+            return Flow(frozenset({'input'}), frozenset(), ())
+        if isinstance(node, ast.Name):
+            return self.name_flow(node.id)
+        if isinstance(node, ast.IfExp):  # the condition picks a value, it is not part of it
+            children = [self.flow(node.body), self.flow(node.orelse)]
+        else:
+            children = [self.flow(child) for child in ast.iter_child_nodes(node)]
+        kinds = frozenset().union(*(child.kinds for child in children))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in self.functions:
+            kinds |= {'unknown'}  # whatever the function returns
+        steps = frozenset().union(*(child.steps for child in children))
+        # opening a file is not a step, reading it is
+        if 'input' in kinds and isinstance(node, OPERATIONS) and not (isinstance(node, ast.Call) and
+                                                                     getattr(node.func, 'id', None) == 'open'):
+            steps |= {node}
+        # an index picks a part of the value, the names in it are not what goes into the prompt
+        carriers = children[:1] if isinstance(node, ast.Subscript) else children
+        return Flow(kinds, steps, tuple(dict.fromkeys(name for child in carriers for name in child.variables)))
+
+    def is_root_source(self, node):
+        # argv, input() or stdin, or a read whose arguments hold no input themselves
+        if isinstance(node, ast.Subscript):
+            return self.is_root_source(node.value)
+        if not is_input_source(node):
+            return False
+        return not any(isinstance(name, ast.Name) and 'input' in self.name_flow(name.id).kinds
+                       for name in ast.walk(node))
+
+    def resolve(self, node):
+        # follows name-to-name aliasing to the expression behind a value
+        seen = set()
+        while isinstance(node, ast.Name) and node.id in self.values and node.id not in seen:
+            seen.add(node.id)
+            node = self.values[node.id]
+        return node
+
+    def template(self, node, depth=0):
+        # the prompt text with every input-derived piece as {}
+        if isinstance(node, ast.Name) and node.id in self.values and depth < 20:
+            value = self.values[node.id]
+            if isinstance(value, (ast.Constant, ast.JoinedStr, ast.BinOp)) or is_format(value):
+                return self.template(value, depth + 1)
+        if isinstance(node, ast.Constant):
+            return str(node.value)
+        if isinstance(node, ast.JoinedStr):
+            return ''.join(part.value if isinstance(part, ast.Constant) else self.template(part.value, depth + 1)
+                           for part in node.values)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return self.template(node.left, depth + 1) + self.template(node.right, depth + 1)
+        if is_format(node):
+            return PLACEHOLDER.sub('{}', node.func.value.value)
+        return '{}' if 'input' in self.flow(node).kinds else ' '
+
+    def messages(self, argument):
+        # (roles, user contents, certain) of a messages list
+        messages = self.resolve(argument)
+        if not isinstance(messages, (ast.List, ast.Tuple)):
+            return [], [], False
+        certain = not (isinstance(argument, ast.Name) and argument.id in self.appended)
+        roles, contents = [], []
+        for element in messages.elts:
+            element = self.resolve(element)
+            if not isinstance(element, ast.Dict):
+                certain = False
+                continue
+            fields = {key.value: value for key, value in zip(element.keys, element.values) if isinstance(key, ast.Constant)}
+            role = self.resolve(fields['role']) if 'role' in fields else None
+            if not (isinstance(role, ast.Constant) and isinstance(role.value, str)):
+                certain = False
+                continue
+            roles.append(role.value)
+            if role.value == 'user' and 'content' in fields:
+                contents.append(fields['content'])
+        return roles, contents, certain
+
+    def answers(self, call):
+        '''(answers, confident) for one LLM call, see classify_code.'''
+        pattern = match_call(call.func, self.finder.dispatch)
+        argument = next((keyword.value for keyword in call.keywords if keyword.arg == pattern.prompt_arg), None)
+        if argument is None:
+            return None, False
+        # a parameter may be bound to anything at its call sites
+        certain = not (isinstance(argument, ast.Name) and argument.id in self.finder.function_parameters)
+        if pattern.prompt_arg == 'messages':
+            roles, contents, confident = self.messages(argument)
+            if not contents:
+                return None, False
+            confident = confident and certain and len(contents) == 1
+            system_and_user = int('system' in roles and 'user' in roles)
+            content = contents[0]
+        else:  # completions take a bare prompt
+            confident, system_and_user, content = certain, 0, argument
+
+        flow = self.flow(content)
+        confident = confident and not flow.kinds & {'parameter', 'unknown'}
+        dynamic = 'input' in flow.kinds
+        template = self.template(content)
+        static_text = PLACEHOLDER.sub(' ', template)
+        words = -1 if mostly_non_ascii(static_text) else len(prompt_word_starts(static_text))
+        placement = steps = None
+        if dynamic:
+            # beginning with no static words before the insertion, end with none after it
+            starts = prompt_word_starts(template)
+            bands = [0 if index == 1 else 2 if index > len(starts) else 1 for index in find_fstring_indices(template, starts)]
+            placement = bands[0] if len(set(bands)) == 1 else 1
+            steps = len(flow.steps)
+            confident = confident and len(set(bands)) == 1 and len(starts) > 0 and steps <= MAX_STEPS
+        return (system_and_user, int(dynamic), list(flow.variables), words, placement, steps), confident
+
+def classify_code(code):
+    '''
+    Answers the classification questions from the AST, as the tuple
+    transform_answers makes of an LLM response (N/A as None), and whether every
+    answer is certain enough to skip the LLM. Code without an LLM call, or that
+    Finder cannot handle, gives (None, False).
+    '''
+    try:
+        tree = ast.parse(code)
+        finder = Finder(code)
+        finder.visit(tree)
+    except Exception:
+        return None, False
+    if not finder.call_nodes:
+        return None, False
+    answers, confident = PromptFlow(tree, finder).answers(finder.call_nodes[0])
+    return answers, confident and len(finder.call_nodes) == 1
+
+def normalise(question, answer):
+    if question == 'variables':
+        return frozenset(word.strip('`.,;:()\'"') for word in answer or ())
+    return answer
+
+def agreement(pairs):
+    '''
+    Share of files where the static answer matches the most common LLM answer,
+    per question, over (static answers, [LLM answers per sample]) pairs.
+    '''
+    matches = Counter()
+    counted = Counter()
+    for static, samples in pairs:
+        if not samples:
+            continue
+        for i, question in enumerate(QUESTIONS):
+            majority, _ = Counter(normalise(question, sample[i]) for sample in samples).most_common(1)[0]
+            counted[question] += 1
+            matches[question] += normalise(question, static[i]) == majority
+    return {question: (matches[question] / counted[question] if counted[question] else None, counted[question])
+            for question in QUESTIONS}
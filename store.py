@@ -0,0 +1,106 @@
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+ROOT = 'results'
+
+LABEL = pa.dictionary(pa.int32(), pa.string())  # urls and repos repeat a lot
+
+SCHEMAS = {
+    # one row per matched call, from parse.py
+    'calls': pa.schema([
+        ('url', LABEL), ('repo', LABEL), ('pattern', LABEL), ('line', pa.int32()),
+    ]),
+    # one row per line of Finder's trace, from parse.py
+    'traces': pa.schema([
+        ('url', LABEL), ('repo', LABEL), ('trace', pa.string()),
+    ]),
+    # one row per (prompt, file) pair, from analysis.py
+    'prompts': pa.schema([
+        ('prompt', pa.string()), ('url', LABEL), ('repo', LABEL),
+        ('length', pa.int32()), ('insertions', pa.int32()),
+        ('indices', pa.list_(pa.int32())), ('positions', pa.list_(pa.float32())),
+        ('insertion_ratio', pa.float32()), ('mean_position', pa.float32()),
+        ('placement', LABEL), ('cluster', pa.string()),
+    ]),
+    # one row per sampled answer, from ask_openai.py
+    'answers': pa.schema([
+        ('repo', LABEL), ('path', pa.string()), ('model', LABEL), ('sample', pa.int16()),
+        ('response', pa.string()), ('error', pa.string()),
+    ]),
+    # one row per classified file, the majority of its sampled answers (model 'static'
+    # for answers from the AST), with the share of samples behind each, from ask_openai.py
+    'labels': pa.schema([
+        ('repo', LABEL), ('path', pa.string()), ('model', LABEL), ('samples', pa.int16()),
+        ('system_and_user', pa.int8()), ('dynamic', pa.int8()), ('variables', pa.list_(pa.string())),
+        ('static_words', pa.int32()), ('placement', pa.int8()), ('steps', pa.int16()),
+        ('agreement', pa.list_(pa.float32())),
+    ]),
+}
+
+def new_run_id():
+    return time.strftime('%Y%m%dT%H%M%S')
+
+def repo_of(url):
+    # https://raw.githubusercontent.com/<owner>/<repo>/<branch>/<path>
+    parts = url.split('/')
+    return '/'.join(parts[3:5]) if len(parts) > 4 else url
+
+class ResultStore:
+    '''
+    Buffers result rows per table and writes them as parquet files under
+    <root>/<table>/run=<run>/, so that every run is its own hive partition
+    and query.py can read any subset of tables, runs and columns.
+    '''
+    def __init__(self, root=ROOT, run=None, batch_size=100000):
+        self.root = root
+        self.run = run or new_run_id()
+        self.batch_size = batch_size
+        self.rows = {table: [] for table in SCHEMAS}
+        self.parts = {table: 0 for table in SCHEMAS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, table, row):
+        rows = self.rows[table]
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush(table)
+
+    def write_result(self, result):
+        '''Rows for one parse.py result record.'''
+        url = result['url']
+        repo = repo_of(url)
+        for call in result.get('calls', []):
+            self.write('calls', {'url': url, 'repo': repo, 'pattern': call['pattern'], 'line': call['line']})
+        for trace in result.get('create_calls', []):
+            self.write('traces', {'url': url, 'repo': repo, 'trace': trace})
+
+    def flush(self, table):
+        rows = self.rows[table]
+        if not rows:
+            return
+        directory = os.path.join(self.root, table, f'run={self.run}')
+        os.makedirs(directory, exist_ok=True)
+        # a part number already on disk means a resumed run, never overwrite it
+        while os.path.exists(os.path.join(directory, f'part-{self.parts[table]:05d}.parquet')):
+            self.parts[table] += 1
+        pq.write_table(pa.Table.from_pylist(rows, schema=SCHEMAS[table]),
+                       os.path.join(directory, f'part-{self.parts[table]:05d}.parquet'))
+        self.parts[table] += 1
+        rows.clear()
+
+    def close(self):
+        for table in SCHEMAS:
+            self.flush(table)
+
+def open_table(table, root=ROOT):
+    return ds.dataset(os.path.join(root, table), format='parquet', partitioning='hive',
+                      schema=SCHEMAS[table].append(pa.field('run', pa.string())))
@@ -0,0 +1,76 @@
+import asyncio
+import functools
+import http.server
+import io
+import json
+import tarfile
+import threading
+
+import pytest
+
+from analyse_code import download_archives
+
+SMALL = b'import openai\n'
+LARGE = b'import openai\n' + b'x = 1\n' * 100
+
+def tarball(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for name, body in files.items():
+            member = tarfile.TarInfo(f'o-r-0123abc/{name}')
+            member.size = len(body)
+            tar.addfile(member, io.BytesIO(body))
+    return data.getvalue()
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    The repository and tarball endpoints of the github api for o/r, and raw
+    files on its main branch. o/gone has no archive, only raw files.
+    '''
+    def __init__(self, requests, *args, **kwargs):
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        routes = {
+            '/repos/o/r': json.dumps({'default_branch': 'main'}).encode(),
+            '/repos/o/r/tarball/main': tarball({'a.py': SMALL, 'pkg/helper.py': SMALL, 'big.py': LARGE,
+                                                'README.md': SMALL, 'notes.ipynb': SMALL}),
+            '/raw/o/r/main/big.py': LARGE,
+            '/raw/o/gone/main/c.py': SMALL,
+        }
+        body = routes.get(self.path)
+        self.send_response(200 if body is not None else 404)
+        self.send_header('Content-Length', str(len(body or b'')))
+        self.end_headers()
+        self.wfile.write(body or b'')
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(ArchiveHandler, requests))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', requests
+    server.shutdown()
+
+def test_archives_keep_every_source_and_fall_back_per_file(server, tmp_path, monkeypatch):
+    base, requests = server
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'repos').mkdir()
+    entries = [('o/r', 'a.py'), ('o/r', 'big.py'), ('o/r', 'missing.py'), ('o/gone', 'c.py')]
+
+    repos = asyncio.run(download_archives(entries, api_base=base, raw_base=f'{base}/raw', max_file_bytes=100))
+
+    assert sorted(repos) == [('o_gone_c.py', 'o/gone', 'c.py'), ('o_r_a.py', 'o/r', 'a.py'),
+                             ('o_r_big.py', 'o/r', 'big.py'), ('o_r_notes.ipynb', 'o/r', 'notes.ipynb'),
+                             ('o_r_pkg_helper.py', 'o/r', 'pkg/helper.py')]
+    assert (tmp_path / 'repos' / 'o_r_big.py').read_bytes() == LARGE
+    assert (tmp_path / 'repos' / 'o_r_pkg_helper.py').read_bytes() == SMALL
+    # the large hit and the repository without an archive are fetched on their own, the file
+    # missing from the archive is not, and the archive's own sources never are
+    raw = sorted(path for path in requests if path.startswith('/raw/'))
+    assert raw == ['/raw/o/gone/main/c.py', '/raw/o/r/main/big.py']
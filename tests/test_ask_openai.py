@@ -0,0 +1,34 @@
+from ask_openai import consensus, read_answers, split_answers, transform_answers
+
+DYNAMIC = '1) Yes.\n2) Dynamic. The dynamic variable is `x`.\n3) 5.\n4) End.\n5) There are 2 steps.'
+STATIC = '1) No.\n2) Static.\n3) Not English.\n4) N/A.\n5) N/A.'
+
+def test_answers_are_read_in_any_order_and_wording():
+    text = '5) two steps\n\nSure!\n3) five words\n1) yes\n4) At the end\n2) dynamic: `x`, `x`'
+    assert transform_answers(split_answers(text)) == transform_answers(split_answers(DYNAMIC)) == (1, 1, ['x'], 5, 2, 2)
+    assert transform_answers(split_answers(STATIC)) == (0, 0, [], -1, None, None)
+
+def test_unreadable_answers_are_left_out():
+    assert read_answers(split_answers('1) Maybe\n3) a lot\n4) somewhere')) == {}
+    assert read_answers(split_answers('1) No\n2)\n3) Not English')) == {0: 0, 3: -1}
+
+def test_consensus_takes_the_majority():
+    answers, agreement, settled = consensus([DYNAMIC, STATIC, DYNAMIC])
+    assert answers == (1, 1, ['x'], 5, 2, 2)
+    assert agreement == [2 / 3] * 6
+    assert settled
+
+def test_consensus_tie_goes_to_the_first_answer_and_is_not_settled():
+    for responses in ([DYNAMIC, STATIC], [STATIC, DYNAMIC]):
+        answers, agreement, settled = consensus(responses)
+        assert answers == transform_answers(split_answers(responses[0]))
+        assert agreement == [0.5] * 6
+        assert not settled
+    answers, _, settled = consensus([DYNAMIC, STATIC, DYNAMIC, STATIC], min_agree=2)
+    assert answers == (1, 1, ['x'], 5, 2, 2) and not settled
+
+def test_consensus_without_readable_answers():
+    answers, agreement, settled = consensus(['I cannot answer that.', DYNAMIC.replace('1) Yes.', '1) Perhaps')])
+    assert answers == (None, 1, ['x'], 5, 2, 2)
+    assert agreement == [None, 1.0, 1.0, 1.0, 1.0, 1.0]
+    assert not settled
@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import http.server
+import json
+import threading
+
+import pytest
+
+from ask_openai import classification_messages, consensus
+from classifier import Classifier, ResponseCache
+
+AGREED = '1) Yes\n2) Dynamic, `x`\n3) 5\n4) End\n5) 2, concatenation'
+OTHER = '1) No\n2) Dynamic, `y`\n3) 7\n4) Beginning\n5) 1, concatenation'
+
+class CompletionHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    A ChatCompletion endpoint that rate limits the first request. Code
+    containing `split` gets the two answers in turn, anything else always the
+    same one.
+    '''
+    def __init__(self, requests, *args, **kwargs):
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests.append(request)
+        if len(self.requests) == 1:
+            return self.reply(429, {'error': {'message': 'rate limited', 'type': 'rate_limit_error'}})
+        split = 'split' in request['messages'][-1]['content']
+        text = OTHER if split and sum('split' in r['messages'][-1]['content'] for r in self.requests) % 2 else AGREED
+        self.reply(200, {'id': 'c', 'object': 'chat.completion',
+                         'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                         'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}})
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def api():
+    requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(CompletionHandler, requests))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/v1', requests
+    server.shutdown()
+
+def classify(api_base, cache, jobs):
+    classifier = Classifier(concurrency=1, tokens_per_minute=10 ** 7, backoff=0.01, cache=cache, api_key='key',
+                            api_base=api_base)
+
+    async def run():
+        settled = lambda responses: consensus(responses)[2]
+        return {key: responses async for key, responses in classifier.sample_many(jobs, 5, settled=settled, min_samples=2)}
+
+    return asyncio.run(run()), classifier.calls
+
+def test_sampling_stops_once_answers_agree_and_reruns_hit_the_cache(api, tmp_path):
+    api_base, requests = api
+    jobs = [('same', classification_messages('x = 1')), ('split', classification_messages('split = 1'))]
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+
+    results, calls = classify(api_base, cache, jobs)
+    assert len(results['same']) == 2  # two agreeing samples settle it
+    assert len(results['split']) == 3  # a tie after two, a majority of two after three
+    assert consensus(results['split'])[1][0] == 2 / 3
+    assert calls == len(requests) == 2 + 3 + 1  # and one retry after the 429
+
+    again, calls = classify(api_base, cache, jobs)
+    cache.close()
+    assert again == results
+    assert calls == 0 and len(requests) == 6
@@ -0,0 +1,8 @@
+import dedup
+from dedup import MinHasher, TOKEN
+
+def test_signature_does_not_depend_on_the_chunk_size(monkeypatch):
+    tokens = TOKEN.findall(' '.join(f'x_{i} = y_{i % 7} + {i}' for i in range(3000)))
+    whole = MinHasher().signature(tokens)
+    monkeypatch.setattr(dedup, 'CHUNK', 100)
+    assert (MinHasher().signature(tokens) == whole).all()
@@ -0,0 +1,88 @@
+import asyncio
+import functools
+import http.server
+import threading
+import time
+
+import pytest
+
+from fetch import Fetcher, raw_url_candidates
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    /flaky fails with a 503 twice and then serves, /busy asks for a retry once,
+    files under main/ are missing so that the master/ ones have to be probed.
+    '''
+    def __init__(self, requests, *args, **kwargs):
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        seen = self.requests.count(self.path)
+        if self.path == '/flaky' and seen <= 2:
+            return self.reply(503)
+        if self.path == '/busy' and seen == 1:
+            return self.reply(429, {'Retry-After': '0.2'})
+        if '/main/' in self.path:
+            return self.reply(404)
+        self.reply(200, body=self.path.encode())
+
+    def reply(self, status, headers=None, body=b''):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stub():
+    requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(StubHandler, requests))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', requests
+    server.shutdown()
+
+def fetched(coroutine_function, **options):
+    async def run():
+        async with Fetcher(**options) as fetcher:
+            return await coroutine_function(fetcher)
+    return asyncio.run(run())
+
+def test_retries_with_backoff_and_retry_after(stub):
+    base, requests = stub
+    start = time.monotonic()
+    flaky, busy = fetched(lambda fetcher: asyncio.gather(fetcher.fetch(f'{base}/flaky'), fetcher.fetch(f'{base}/busy')),
+                          backoff=0.05)
+    assert (flaky.status, flaky.body) == (200, b'/flaky')
+    assert (busy.status, busy.body) == (200, b'/busy')
+    assert requests.count('/flaky') == 3 and requests.count('/busy') == 2
+    assert time.monotonic() - start >= 0.2  # 0.05 + 0.1 of backoff, and the Retry-After
+
+def test_gives_up_after_the_retries(stub):
+    base, requests = stub
+    res = fetched(lambda fetcher: fetcher.fetch(f'{base}/flaky'), retries=1, backoff=0)
+    assert res.status == 503 and requests == ['/flaky', '/flaky']
+
+def test_branch_probe_downloads_each_file_once(stub):
+    base, requests = stub
+    jobs = [raw_url_candidates('o/r', f'{name}.py', base) for name in ('a', 'b')]
+
+    async def fetch_all(fetcher):
+        return [(job, res) async for job, res in fetcher.fetch_many(jobs)]
+
+    results = fetched(fetch_all)
+    assert [res.url for _, res in results] == [f'{base}/o/r/master/a.py', f'{base}/o/r/master/b.py']
+    assert [res.body for _, res in results] == [b'/o/r/master/a.py', b'/o/r/master/b.py']
+    assert sorted(requests) == ['/o/r/main/a.py', '/o/r/main/b.py', '/o/r/master/a.py', '/o/r/master/b.py']
+
+def test_per_host_rate(stub):
+    base, requests = stub
+    start = time.monotonic()
+    fetched(lambda fetcher: asyncio.gather(*(fetcher.fetch(f'{base}/file{i}') for i in range(5))), per_host_rate=20)
+    assert len(requests) == 5
+    assert time.monotonic() - start >= 4 / 20
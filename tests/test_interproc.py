@@ -0,0 +1,31 @@
+from interproc import Resolver
+from parse import find_llm_calls, repo_url
+
+LLM = '''import openai
+
+def ask(prompt):
+    messages = [{"role": "user", "content": prompt}]
+    return openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=messages)
+'''
+
+MAIN = '''import sys
+from llm import ask
+
+ask("Explain " + sys.argv[1])
+'''
+
+def test_prompt_built_from_a_parameter_is_resolved(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'repos').mkdir()
+    (tmp_path / 'repos' / 'llm.py').write_text(LLM)
+    (tmp_path / 'repos' / 'main.py').write_text(MAIN)
+    entries = [('llm.py', 'u/r', 'pkg/llm.py'), ('main.py', 'u/r', 'pkg/main.py')]
+    interactions, calls = find_llm_calls(LLM)
+    result = {"url": repo_url(entries[0]), "create_calls": interactions, "calls": calls}
+
+    resolved = Resolver(entries).resolve(result)
+
+    assert resolved["create_calls"][len(interactions):] == [
+        "'prompt' of function 'ask' is passed \"Explain \" + sys.argv[1] in pkg/main.py line 4",
+        'Input source: sys.argv',
+    ]
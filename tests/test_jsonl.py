@@ -0,0 +1,12 @@
+from jsonl import JsonlWriter, read_jsonl
+
+def test_keyed_writer_skips_records_a_rerun_already_wrote(tmp_path):
+    path = str(tmp_path / 'out.jsonl')
+    with JsonlWriter(path, key='url') as out:
+        assert out.write({'url': 'a', 'n': 1})
+        assert not out.write({'url': 'a', 'n': 2})
+    with JsonlWriter(path, key='url') as out:
+        assert 'a' in out
+        assert not out.write({'url': 'a', 'n': 3})
+        assert out.write({'url': 'b', 'n': 4})
+    assert list(read_jsonl(path)) == [{'url': 'a', 'n': 1}, {'url': 'b', 'n': 4}]
@@ -0,0 +1,62 @@
+import asyncio
+import re
+
+from ask_openai import read_answers, split_answers
+from packing import PackedSampler, split_packed
+
+def answers(n, upto=5):
+    lines = ['1) Yes', f'2) Dynamic, `v{n}`', f'3) {n}', '4) End', '5) 1']
+    return '\n'.join(lines[:upto])
+
+def words(text):
+    return read_answers(split_answers(text))[3]
+
+def test_sections_are_matched_by_id_in_any_order():
+    text = f'Here you go.\n\n**Snippet 2:**\n{answers(20)}\n\n### Snippet #1\n{answers(10)}\n'
+    sections = split_packed(text, {'1', '2'})
+    assert {id: words(section) for id, section in sections.items()} == {'1': 10, '2': 20}
+
+def test_malformed_sections_are_left_out():
+    text = (f'### Snippet 1\n{answers(10, upto=3)}\n'  # answers cut short
+            f'### Snippet 2\n{answers(20)}\n{answers(30)}\n'  # the header of 3 is missing
+            f'### Snippet 4\n{answers(40)}\n### Snippet 4\n{answers(41)}\n'  # answered twice, the first one counts
+            f'### Snippet 9\n{answers(90)}\n')  # not in the pack, and lands in the section of 4
+    sections = split_packed(text, {'1', '2', '3', '4'})
+    assert sections.keys() == {'4'}
+    assert words(sections['4']) == 40
+
+class ScriptedClassifier:
+    '''
+    Answers each file with its own number. A pack of three or more comes back in
+    reverse, cut short for the second file and without the last one; a smaller
+    pack loses the header between its two files.
+    '''
+    max_tokens = 256
+    concurrency = 1
+
+    def __init__(self):
+        self.prompts = []
+
+    async def complete(self, messages, sample=0, max_tokens=None):
+        content = messages[-1]['content']
+        self.prompts.append(content)
+        files = dict(re.findall(r'### Snippet (\d+)\nfile (\d+)\n', content))
+        if not files:
+            return answers(int(re.search(r'piece of code: file (\d+)', content).group(1)))
+        ids = list(files)
+        if len(ids) >= 3:
+            return '\n\n'.join(f'**Snippet {id}:**\n{answers(files[id], 3 if id == "2" else 5)}'
+                               for id in reversed(ids[:-1]))
+        return f'### Snippet {ids[0]}\n' + '\n'.join(answers(files[id]) for id in ids)
+
+def test_packed_sampler_gives_every_file_its_own_answers():
+    classifier = ScriptedClassifier()
+    sampler = PackedSampler(classifier, samples=1)
+    batch = [(key, f'file {n}') for key, n in (('a', 11), ('b', 12), ('c', 13), ('d', 14))]
+
+    responses = asyncio.run(sampler.sample(batch))
+
+    assert {key: [words(text) for text in texts] for key, texts in responses.items()} == {
+        'a': [11], 'b': [12], 'c': [13], 'd': [14]}
+    # the pack of four, the pack of b and d it left out, then b and d alone
+    assert (sampler.requests, sampler.repacked, sampler.alone) == (4, 1, 2)
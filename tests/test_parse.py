@@ -0,0 +1,51 @@
+import time
+
+import parse
+from dedup import LSHIndex
+from sandbox import Quarantine
+
+SOURCE = '''import openai
+import sys
+
+question = sys.argv[1]
+response = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": question}])
+print(response)
+'''
+
+def slow_find_llm_calls(code):
+    time.sleep(30)
+
+def test_quarantined_representative_fails_its_duplicates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'repos').mkdir()
+    for name in ('a.py', 'b.py', 'c.py'):
+        (tmp_path / 'repos' / name).write_text(SOURCE)
+    monkeypatch.setattr(parse, 'find_llm_calls', slow_find_llm_calls)  # the workers are forked after this
+    entries = [('a.py', 'o/a', 'a.py'), ('b.py', 'o/b', 'b.py'), ('c.py', 'o/c', 'c.py')]
+    quarantine = Quarantine(str(tmp_path / 'quarantine.jsonl'), load=False)
+
+    results = list(parse.scan_repo_files(entries, dedup=LSHIndex(0.9), sandbox={'timeout': 1}, quarantine=quarantine))
+    quarantine.close()
+
+    assert [url for url, _, _ in results] == [parse.repo_url(entry) for entry in entries]
+    assert all(result is None for _, result, _ in results)
+    assert results[0][2].startswith('quarantined a.py: timed out')
+    for _, _, error in results[1:]:
+        assert error.endswith(f'(duplicate of {parse.repo_url(entries[0])})')
+    assert 'repos/a.py' in quarantine and 'repos/b.py' not in quarantine
+
+def test_parallel_scan_matches_the_serial_one(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'repos').mkdir()
+    entries = []
+    for i in range(12):
+        code = SOURCE.replace('question', f'question_{i}') if i % 4 else 'import openai\nopenai.ChatCompletion.create(\n'
+        (tmp_path / 'repos' / f'f{i}.py').write_text(code)
+        entries.append((f'f{i}.py', f'o/r{i}', f'f{i}.py'))
+    entries.append(('missing.py', 'o/m', 'missing.py'))
+
+    serial = list(parse.scan_repo_files(entries))
+    parallel = list(parse.scan_repo_files(entries, workers=3, chunk_size=1))
+
+    assert parallel == serial
+    assert sum(1 for _, result, _ in serial if result and result['calls']) == 9
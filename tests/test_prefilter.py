@@ -0,0 +1,40 @@
+import json
+
+from parse import repo_url, scan_repo_files
+from patterns import PATTERNS
+from prefilter import PREFILTER
+
+def call_source(pattern):
+    root = 'openai' if pattern.name_root else 'client'
+    return (f'import openai\nimport sys\nclient = openai.OpenAI()\n'
+            f'r = {root}.{".".join(pattern.chain)}(model="m", {pattern.prompt_arg}=sys.argv[1])\n')
+
+def notebook(code):
+    return json.dumps({'cells': [{'cell_type': 'code', 'source': code.splitlines(True)}]})
+
+def corpus():
+    files = {f'call_{i}.py': call_source(pattern) for i, pattern in enumerate(PATTERNS)}
+    files['fullwidth.py'] = 'import openai\nopenai.ChatCompletion.ｃreate(model="m", messages=[])\n'
+    files['latin1.py'] = '# -*- coding: latin-1 -*-\n# caf\xe9\nimport openai\nopenai.Completion.create(prompt="p")\n'
+    files['cell.ipynb'] = notebook(call_source(PATTERNS[0]))
+    files['plain.py'] = 'import json\nprint(json.dumps({"create": 1}))\n'
+    files['plain.ipynb'] = notebook('print("no calls here")\n')
+    return files
+
+def test_prefilter_skips_no_file_with_calls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'repos').mkdir()
+    entries = []
+    for fn, code in corpus().items():
+        (tmp_path / 'repos' / fn).write_bytes(code.encode('latin-1' if fn == 'latin1.py' else 'utf-8'))
+        entries.append((fn, 'o/r', fn))
+
+    everything = {url: result for url, result, _ in scan_repo_files(entries, prefilter=None)}
+    filtered = {url: result for url, result, _ in scan_repo_files(entries, prefilter=PREFILTER)}
+
+    with_calls = [url for url, result in everything.items() if result and result['calls']]
+    assert len(with_calls) == len(PATTERNS) + 3
+    for url in with_calls:
+        assert filtered[url] == everything[url]
+    assert filtered[repo_url(('plain.py', 'o/r', 'plain.py'))] is None
+    assert filtered[repo_url(('plain.ipynb', 'o/r', 'plain.ipynb'))] is None
@@ -0,0 +1,56 @@
+import asyncio
+import functools
+import http.server
+import importlib
+import json
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+class SearchHandler(http.server.BaseHTTPRequestHandler):
+    '''Code search with 150 hits that leaves no requests in the window after each response.'''
+    def __init__(self, requests, *args, **kwargs):
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        page = int(parse_qs(urlsplit(self.path).query)['page'][0])
+        self.requests.append(page)
+        items = [{'repository': {'id': page, 'full_name': f'o/r{page}'}, 'path': f'{i}.py'} for i in range(3)]
+        body = json.dumps({'total_count': 150, 'items': items}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-RateLimit-Remaining', '0')
+        self.send_header('X-RateLimit-Reset', str(int(time.time())))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def repo_search(tmp_path, monkeypatch):
+    # the module reads its token from the working directory on import
+    (tmp_path / 'github_token').write_text('token\n')
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('repo_search', None)
+    yield importlib.import_module('repo_search')
+    sys.modules.pop('repo_search', None)
+
+def test_one_worker_outlasts_an_empty_window(repo_search, tmp_path, monkeypatch):
+    requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(SearchHandler, requests))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(repo_search, 'SEARCH_URL', f'http://127.0.0.1:{server.server_port}/search/code')
+    harvester = repo_search.Harvester('openai', str(tmp_path / 'checkpoint.jsonl'), max_pages=2, concurrency=1)
+
+    try:
+        asyncio.run(asyncio.wait_for(harvester.run(), 20))
+    finally:
+        server.shutdown()
+
+    assert sorted(requests) == [1, 2]
+    assert len(list(harvester.results())) == 6
@@ -0,0 +1,60 @@
+import re
+import textwrap
+
+import pytest
+
+from ask_openai import INSTRUCTIONS
+from static_classifier import classify_code
+
+HEADER = 'import openai\nimport sys\n'
+
+EXAMPLE = re.compile(r'\n *Example (\d): *\n(.*?)\n *An example response to Example \1', re.S)
+
+def prompt_examples():
+    return {int(number): textwrap.dedent(code) for number, code in EXAMPLE.findall(INSTRUCTIONS)}
+
+def chat(content, indent=''):
+    return f'{indent}r = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=[{{"role": "user", "content": {content}}}])\n'
+
+@pytest.mark.parametrize('code', [
+    HEADER + 'for arg in sys.argv[1:]:\n' + chat('"Define " + arg', '    '),
+    HEADER + 'a, b = sys.argv[1], sys.argv[2]\n' + chat('"Define " + a'),
+    HEADER + 'if (q := input()):\n' + chat('"Define " + q', '    '),
+    HEADER + 'try:\n    q = sys.argv[1]\nexcept IndexError:\n    q = "default"\n' + chat('"Define " + q'),
+], ids=['loop target', 'unpacking', 'walrus', 'rebound'])
+def test_names_not_bound_by_one_assignment_are_not_certain(code):
+    _, confident = classify_code(code)
+    assert not confident
+
+def test_imports_and_builtins_are_static():
+    code = HEADER + 'import json\nq = json.dumps(str(len("abc")))\n' + chat('q')
+    assert classify_code(code) == ((0, 0, [], 0, None, None), True)
+
+@pytest.mark.parametrize('number, expected', [
+    # steps: the reference counts 3, slicing and concatenation only, hence not confident
+    (1, ((1, 1, ['buffer'], 5, 2, 5), False)),
+    # the reference answers, but `code` and `file` are bound twice
+    (2, ((0, 1, ['path'], 23, 1, 2), False)),
+    # the reference answers, the messages come in through a parameter
+    (3, ((0, 0, [], -1, None, None), False)),
+])
+def test_prompt_examples(number, expected):
+    assert classify_code(prompt_examples()[number]) == expected
+
+def test_condition_is_not_a_step():
+    code = HEADER + 'x = sys.argv[1] if len(sys.argv) > 1 else "a default"\n' + chat('"Define " + x')
+    assert classify_code(code) == ((0, 1, ['x'], 1, 2, 1), True)
+
+def test_index_is_not_a_variable():
+    code = HEADER + 'n = int(sys.argv[1])\ntext = sys.stdin.read()\n' + chat('"Summarise " + text[:n]')
+    answers, _ = classify_code(code)
+    assert answers[2] == ['text']
+
+def test_fences_and_contractions():
+    code = HEADER + 'q = sys.argv[1]\n' + chat('f"Fix this:\\n```py\\n{q}\\n```\\nDon\'t explain."')
+    assert classify_code(code) == ((0, 1, ['q'], 4, 1, 1), True)
+
+def test_unpacked_message_dict_is_left_to_the_llm():
+    code = HEADER + ('d = {"name": "x"}\n'
+                     'openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=[{**d, "role": "user", "content": "hi"}])\n')
+    assert classify_code(code) == (None, False)